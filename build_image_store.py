@@ -0,0 +1,61 @@
+import argparse
+
+from dassl.config import get_cfg_default
+from dassl.data.datasets import build_dataset
+from dassl.data.image_store import build_image_store
+
+from train import extend_cfg
+
+
+def main(args):
+    cfg = get_cfg_default()
+    extend_cfg(cfg)
+    if args.dataset_config_file:
+        cfg.merge_from_file(args.dataset_config_file)
+    if args.config_file:
+        cfg.merge_from_file(args.config_file)
+    cfg.merge_from_list(args.opts)
+    if args.root:
+        cfg.DATASET.ROOT = args.root
+
+    dataset = build_dataset(cfg)
+    impaths = []
+    for split in args.splits:
+        data_source = getattr(dataset, split)
+        if data_source:
+            impaths += [item.impath for item in data_source]
+
+    # Keep a margin above the network input for random crops
+    short_side = args.short_side or int(max(cfg.INPUT.SIZE) * 1.15)
+    build_image_store(impaths, args.output_dir, short_side, num_workers=args.workers)
+    print(f"Run with DATALOADER.IMAGE_STORE {args.output_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument("--output-dir", type=str, required=True, help="directory of the image store")
+    parser.add_argument(
+        "--dataset-config-file",
+        type=str,
+        default="",
+        help="path to config file for dataset setup",
+    )
+    parser.add_argument(
+        "--config-file", type=str, default="", help="path to config file (for INPUT.SIZE)"
+    )
+    parser.add_argument(
+        "--splits", type=str, nargs="+", default=["train_x", "val", "test"], help="dataset splits to store"
+    )
+    parser.add_argument(
+        "--short-side", type=int, default=0, help="short side of the stored images, 0 = 1.15 x INPUT.SIZE"
+    )
+    parser.add_argument("--workers", type=int, default=8, help="decoding processes")
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="modify config options using the command-line",
+    )
+    args = parser.parse_args()
+    main(args)
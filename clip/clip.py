@@ -23,7 +23,7 @@ if torch.__version__.split(".") < ["1", "7", "1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
+__all__ = ["available_models", "load", "tokenize", "tokenize_with_lengths"]
 _tokenizer = _Tokenizer()
 
 _MODELS = {
@@ -36,6 +36,30 @@ _MODELS = {
 }
 
 
+def _sha256(path: str):
+    """SHA256 of a file, cached in a sidecar file keyed by its size and mtime."""
+    stat = os.stat(path)
+    key = f"{stat.st_size} {stat.st_mtime_ns}"
+    sidecar = path + ".sha256"
+    if os.path.isfile(sidecar):
+        with open(sidecar) as f:
+            cached_key, _, digest = f.read().strip().rpartition(" ")
+        if cached_key == key:
+            return digest
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(chunk)
+    digest = sha256.hexdigest()
+    try:
+        with open(sidecar, "w") as f:
+            f.write(f"{key} {digest}\n")
+    except OSError:
+        pass
+    return digest
+
+
 def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -47,7 +71,7 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _sha256(download_target) == expected_sha256:
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
@@ -62,7 +86,7 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if _sha256(download_target) != expected_sha256:
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
     return download_target
@@ -201,15 +225,35 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     -------
     A two-dimensional tensor containing the resulting tokens, shape = [number of input strings, context_length]
     """
+    return tokenize_with_lengths(texts, context_length, truncate)[0]
+
+
+def tokenize_with_lengths(texts: Union[str, List[str]], context_length: int = 77, truncate: bool = False):
+    """
+    Tokenize a batch of strings in one pass, like `tokenize`, and also return
+    the number of BPE tokens of every string (without the start/end tokens).
+    Repeated strings are encoded once.
+
+    Returns
+    -------
+    A tuple of the token tensor, shape = [number of input strings, context_length],
+    and a list of lengths
+    """
     if isinstance(texts, str):
         texts = [texts]
 
     sot_token = _tokenizer.encoder["<|startoftext|>"]
     eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
-
-    for i, tokens in enumerate(all_tokens):
+    encoded = {}
+    for text in texts:
+        if text not in encoded:
+            encoded[text] = _tokenizer.encode(text)
+    result = torch.zeros(len(texts), context_length, dtype=torch.long)
+    lengths = []
+
+    for i, text in enumerate(texts):
+        lengths.append(len(encoded[text]))
+        tokens = [sot_token] + encoded[text] + [eot_token]
         if len(tokens) > context_length:
             if truncate:
                 tokens = tokens[:context_length]
@@ -218,4 +262,4 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
                 raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
         result[i, :len(tokens)] = torch.tensor(tokens)
 
-    return result
+    return result, lengths
@@ -1,6 +1,7 @@
 import gzip
 import html
 import os
+from collections import OrderedDict
 from functools import lru_cache
 
 import ftfy
@@ -60,7 +61,7 @@ def whitespace_clean(text):
 
 
 class SimpleTokenizer(object):
-    def __init__(self, bpe_path: str = default_bpe()):
+    def __init__(self, bpe_path: str = default_bpe(), cache_size: int = 1 << 16):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
         merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
@@ -74,11 +75,17 @@ class SimpleTokenizer(object):
         self.encoder = dict(zip(vocab, range(len(vocab))))
         self.decoder = {v: k for k, v in self.encoder.items()}
         self.bpe_ranks = dict(zip(merges, range(len(merges))))
-        self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        self.special_tokens = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
+        # Least-recently-used BPE results, at most cache_size words
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
     def bpe(self, token):
+        if token in self.special_tokens:
+            return self.special_tokens[token]
         if token in self.cache:
+            self.cache.move_to_end(token)
             return self.cache[token]
         word = tuple(token[:-1]) + ( token[-1] + '</w>',)
         pairs = get_pairs(word)
@@ -116,6 +123,8 @@ class SimpleTokenizer(object):
                 pairs = get_pairs(word)
         word = ' '.join(word)
         self.cache[token] = word
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
         return word
 
     def encode(self, text):
@@ -57,6 +57,11 @@ _C.INPUT.RGS_P = 0.2
 # Gaussian blur
 _C.INPUT.GB_P = 0.5  # propability of applying this operation
 _C.INPUT.GB_K = 21  # kernel size (should be an odd number)
+# Run the transforms on collated uint8 batches on the model's device
+# instead of per image in data-loader workers (see batch_transforms.py)
+_C.INPUT.BATCH_TRANSFORMS = False
+# Side of the square uint8 images collated for training, 0 = 1.5 x SIZE
+_C.INPUT.BATCH_TRANSFORMS_SIZE = 0
 
 ###########################
 # Dataset
@@ -86,6 +91,9 @@ _C.DATASET.CIFAR_C_TYPE = ""
 _C.DATASET.CIFAR_C_LEVEL = 1
 # Use all data in the unlabeled data set (e.g. FixMatch)
 _C.DATASET.ALL_AS_UNLABELED = False
+# Share one dataset among the build_dataset calls of a process and keep
+# a columnar index of it in the split_fewshot/ directory of the dataset
+_C.DATASET.INDEX_CACHE = True
 
 ###########################
 # Dataloader
@@ -97,6 +105,9 @@ _C.DATALOADER.K_TRANSFORMS = 1
 # img0 denotes image tensor without augmentation
 # Useful for consistency learning
 _C.DATALOADER.RETURN_IMG0 = False
+# Directory of an image store built by build_image_store.py; images found
+# there are read from it instead of being decoded from disk
+_C.DATALOADER.IMAGE_STORE = ""
 # Setting for the train_x data-loader
 _C.DATALOADER.TRAIN_X = CN()
 _C.DATALOADER.TRAIN_X.SAMPLER = "RandomSampler"
@@ -122,6 +133,15 @@ _C.DATALOADER.TRAIN_U.N_INS = 16
 _C.DATALOADER.TEST = CN()
 _C.DATALOADER.TEST.SAMPLER = "SequentialSampler"
 _C.DATALOADER.TEST.BATCH_SIZE = 32
+# Setting for no-grad scoring passes (active-learning selection, feature
+# extraction)
+_C.DATALOADER.INFER = CN()
+_C.DATALOADER.INFER.BATCH_SIZE = 0  # 0 = DATALOADER.TRAIN_X.BATCH_SIZE
+# Probe the largest batch that fits on the GPU (halving on OOM), starting
+# from MAX_BATCH_SIZE, and remember it per backbone/precision in CACHE_FILE
+_C.DATALOADER.INFER.AUTO_TUNE = False
+_C.DATALOADER.INFER.MAX_BATCH_SIZE = 1024
+_C.DATALOADER.INFER.CACHE_FILE = "cache/infer_batch_size.json"
 
 ###########################
 # Model
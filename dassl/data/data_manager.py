@@ -6,8 +6,10 @@ from torch.utils.data import Dataset as TorchDataset
 from dassl.utils import read_image
 
 from .datasets import build_dataset
+from .image_store import get_image_store
 from .samplers import build_sampler
 from .transforms import INTERPOLATION_MODES, build_transform
+from .transforms.batch_transforms import BatchTransform, BatchTransformLoader
 
 
 def build_data_loader(
@@ -19,17 +21,20 @@ def build_data_loader(
     n_ins=2,
     tfm=None,
     is_train=True,
-    dataset_wrapper=None
+    dataset_wrapper=None,
+    sampler=None,
+    persistent_workers=False
 ):
     # Build sampler
-    sampler = build_sampler(
-        sampler_type,
-        cfg=cfg,
-        data_source=data_source,
-        batch_size=batch_size,
-        n_domain=n_domain,
-        n_ins=n_ins
-    )
+    if sampler is None:
+        sampler = build_sampler(
+            sampler_type,
+            cfg=cfg,
+            data_source=data_source,
+            batch_size=batch_size,
+            n_domain=n_domain,
+            n_ins=n_ins
+        )
 
     if dataset_wrapper is None:
         dataset_wrapper = DatasetWrapper
@@ -41,10 +46,20 @@ def build_data_loader(
         sampler=sampler,
         num_workers=cfg.DATALOADER.NUM_WORKERS,
         drop_last=is_train and len(data_source) >= batch_size,
-        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA)
+        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA),
+        persistent_workers=persistent_workers and cfg.DATALOADER.NUM_WORKERS > 0
     )
     # assert len(data_loader) > 0
 
+    # Batch transforms run on the collated images
+    tfms = tfm if isinstance(tfm, (list, tuple)) else [tfm]
+    keys = ["img"] + [f"img{i + 1}" for i in range(1, len(tfms))]
+    batch_tfms = {key: t for key, t in zip(keys, tfms) if isinstance(t, BatchTransform)}
+    if batch_tfms:
+        use_cuda = torch.cuda.is_available() and cfg.USE_CUDA
+        device = torch.device("cuda", torch.cuda.current_device()) if use_cuda else torch.device("cpu")
+        data_loader = BatchTransformLoader(data_loader, batch_tfms, device)
+
     return data_loader
 
 
@@ -195,6 +210,9 @@ class DatasetWrapper(TorchDataset):
         # Augmenting an image K>1 times is only allowed during training
         self.k_tfm = cfg.DATALOADER.K_TRANSFORMS if is_train else 1
         self.return_img0 = cfg.DATALOADER.RETURN_IMG0
+        self.image_store = None
+        if cfg.DATALOADER.IMAGE_STORE:
+            self.image_store = get_image_store(cfg.DATALOADER.IMAGE_STORE)
 
         if self.k_tfm > 1 and transform is None:
             raise ValueError(
@@ -227,7 +245,9 @@ class DatasetWrapper(TorchDataset):
             "index": idx
         }
 
-        img0 = read_image(item.impath)
+        img0 = self.image_store.read(item.impath) if self.image_store is not None else None
+        if img0 is None:
+            img0 = read_image(item.impath)
 
         if self.transform is not None:
             if isinstance(self.transform, (list, tuple)):
@@ -249,6 +269,8 @@ class DatasetWrapper(TorchDataset):
         return output
 
     def _transform_image(self, tfm, img0):
+        if isinstance(tfm, BatchTransform):
+            tfm = tfm.sample_transform
         img_list = []
 
         for k in range(self.k_tfm):
@@ -4,10 +4,9 @@ import os.path as osp
 import tarfile
 import zipfile
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import gdown
 
-from dassl.utils import check_isfile
-
 
 class Datum:
     """Data instance which defines the basic attributes.
@@ -17,11 +16,15 @@ class Datum:
         label (int): class label.
         domain (int): domain label.
         classname (str): class name.
+
+    Existence of ``impath`` is checked once per dataset (see
+    ``DatasetBase.check_files``) rather than per instance.
     """
 
+    __slots__ = ("_impath", "_label", "_domain", "_classname")
+
     def __init__(self, impath="", label=0, domain=0, classname=""):
         assert isinstance(impath, str)
-        assert check_isfile(impath)
 
         self._impath = impath
         self._label = label
@@ -44,6 +47,14 @@ class Datum:
     def classname(self):
         return self._classname
 
+    def __getstate__(self):
+        return {key: getattr(self, key) for key in self.__slots__}
+
+    def __setstate__(self, state):
+        # Also reads pickles from before __slots__, whose state is __dict__
+        for key, value in state.items():
+            setattr(self, key, value)
+
 
 class DatasetBase:
     """A unified dataset class for
@@ -55,7 +66,9 @@ class DatasetBase:
     dataset_dir = ""  # the directory where the dataset is stored
     domains = []  # string names of all domains
 
-    def __init__(self, train_x=None, train_u=None, val=None, test=None):
+    def __init__(self, train_x=None, train_u=None, val=None, test=None, validate=True):
+        if validate:
+            self.check_files(train_x, train_u, val, test)
         self._train_x = train_x  # labeled training data
         self._train_u = train_u  # unlabeled training data (optional)
         self._val = val  # validation data (optional)
@@ -91,6 +104,27 @@ class DatasetBase:
     def num_classes(self):
         return self._num_classes
 
+    @staticmethod
+    def check_files(*data_sources, num_workers=16):
+        """Check that every image exists, with the stat calls spread over
+        ``num_workers`` threads (they mostly wait on the file system).
+
+        Args:
+            data_sources: lists of Datum objects, None is skipped.
+        """
+        impaths = set()
+        for data_source in data_sources:
+            if data_source:
+                impaths.update(item.impath for item in data_source)
+        impaths = sorted(impaths)
+        with ThreadPoolExecutor(num_workers) as executor:
+            exists = list(executor.map(osp.isfile, impaths, chunksize=256))
+        missing = [impath for impath, ok in zip(impaths, exists) if not ok]
+        if missing:
+            raise FileNotFoundError(
+                "{} images not found, e.g. {}".format(len(missing), missing[:5])
+            )
+
     @staticmethod
     def get_num_classes(data_source):
         """Count number of classes.
@@ -1,11 +1,40 @@
+import os.path as osp
+
 from dassl.utils import Registry, check_availability
 
+from .index import dataset_key, save_dataset_index, load_dataset_index, copy_dataset
+
 DATASET_REGISTRY = Registry("DATASET")
 
+_DATASETS = {}  # dataset key -> dataset built in this process
+
 
 def build_dataset(cfg):
     avai_datasets = DATASET_REGISTRY.registered_names()
     check_availability(cfg.DATASET.NAME, avai_datasets)
     if cfg.VERBOSE:
         print("Loading dataset: {}".format(cfg.DATASET.NAME))
-    return DATASET_REGISTRY.get(cfg.DATASET.NAME)(cfg)
+    dataset_cls = DATASET_REGISTRY.get(cfg.DATASET.NAME)
+    if not cfg.DATASET.INDEX_CACHE:
+        return dataset_cls(cfg)
+
+    # Every call in a process shares one dataset, and readers that keep a
+    # split_fewshot/ directory also store it there as a columnar index
+    root = osp.abspath(osp.expanduser(cfg.DATASET.ROOT))
+    dataset_dir = osp.join(root, dataset_cls.dataset_dir)
+    key = dataset_key(cfg, dataset_dir)
+    if key not in _DATASETS:
+        path = osp.join(dataset_dir, "split_fewshot", f"index_{key}.npz")
+        if osp.exists(path):
+            print(f"Loading dataset index from {path}")
+            _DATASETS[key] = load_dataset_index(dataset_cls, path)
+        else:
+            dataset = dataset_cls(cfg)
+            # The reader may have created files in dataset_dir
+            key = dataset_key(cfg, dataset_dir)
+            path = osp.join(dataset_dir, "split_fewshot", f"index_{key}.npz")
+            if osp.isdir(osp.dirname(path)):
+                save_dataset_index(dataset, path)
+                print(f"Saved dataset index to {path}")
+            _DATASETS[key] = dataset
+    return copy_dataset(_DATASETS[key])
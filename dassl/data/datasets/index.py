@@ -0,0 +1,124 @@
+import os
+import copy
+import hashlib
+import os.path as osp
+import numpy as np
+
+from .base_dataset import Datum, DatasetBase
+
+SPLITS = ("train_x", "train_u", "val", "test")
+SPLIT_FILE_EXTS = (".json", ".pkl", ".txt")
+
+
+class DatasetIndex:
+    """Columnar storage of a list of Datum.
+
+    Paths, labels, domains and class names are kept as numpy columns, so a
+    split of a dataset can be written to and read from a single npz file
+    without one Python object (and one stat call) per image. Indexing
+    returns a ``Datum`` row.
+    """
+
+    def __init__(self, impaths, labels, domains, classnames):
+        self.impaths = np.asarray(impaths, dtype=str)
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.domains = np.asarray(domains, dtype=np.int64)
+        self.classnames = np.asarray(classnames, dtype=str)
+
+    @classmethod
+    def from_data(cls, data_source):
+        return cls(
+            [item.impath for item in data_source],
+            [item.label for item in data_source],
+            [item.domain for item in data_source],
+            [item.classname for item in data_source],
+        )
+
+    def __len__(self):
+        return len(self.impaths)
+
+    def __getitem__(self, idx):
+        return Datum(
+            impath=str(self.impaths[idx]),
+            label=int(self.labels[idx]),
+            domain=int(self.domains[idx]),
+            classname=str(self.classnames[idx]),
+        )
+
+    def to_list(self):
+        columns = zip(
+            self.impaths.tolist(), self.labels.tolist(),
+            self.domains.tolist(), self.classnames.tolist()
+        )
+        return [Datum(impath, label, domain, classname) for impath, label, domain, classname in columns]
+
+
+def _split_files(dataset_dir):
+    """(name, mtime) of the split files in ``dataset_dir`` and its
+    split_fewshot/ directory, without the indexes themselves."""
+    files = []
+    for folder in (dataset_dir, osp.join(dataset_dir, "split_fewshot")):
+        if not osp.isdir(folder):
+            continue
+        for entry in os.scandir(folder):
+            if entry.name.endswith(SPLIT_FILE_EXTS) and not entry.name.startswith("index_") and entry.is_file():
+                files.append((osp.relpath(entry.path, dataset_dir), entry.stat().st_mtime_ns))
+    return sorted(files)
+
+
+def dataset_key(cfg, dataset_dir):
+    """Hash of everything a dataset reader depends on.
+
+    The mtime of the dataset directory changes when a split file is added
+    or removed, and the mtimes of the split files when one is rewritten in
+    place. Either invalidates indexes written before.
+    """
+    mtime = os.stat(dataset_dir).st_mtime_ns if osp.isdir(dataset_dir) else 0
+    key = repr((
+        cfg.DATASET.NAME, dataset_dir, mtime, _split_files(dataset_dir), cfg.SEED, cfg.DATASET.NUM_SHOTS,
+        cfg.DATASET.get("SUBSAMPLE_CLASSES", "all"),
+        tuple(cfg.DATASET.SOURCE_DOMAINS), tuple(cfg.DATASET.TARGET_DOMAINS),
+    ))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+
+def save_dataset_index(dataset, path):
+    columns = {}
+    for split in SPLITS:
+        data_source = getattr(dataset, split)
+        if data_source is None:
+            continue
+        index = DatasetIndex.from_data(data_source)
+        for name in ("impaths", "labels", "domains", "classnames"):
+            columns[f"{split}.{name}"] = getattr(index, name)
+    tmp = path + ".tmp.npz"
+    np.savez(tmp, **columns)
+    os.replace(tmp, path)
+
+
+def load_dataset_index(dataset_cls, path):
+    """Rebuild a ``dataset_cls`` instance from an index written by
+    ``save_dataset_index`` without running its reader."""
+    with np.load(path) as data:
+        splits = {}
+        for split in SPLITS:
+            if f"{split}.impaths" not in data:
+                continue
+            splits[split] = DatasetIndex(
+                *[data[f"{split}.{name}"] for name in ("impaths", "labels", "domains", "classnames")]
+            ).to_list()
+    dataset = dataset_cls.__new__(dataset_cls)
+    # Images are only checked when they are read
+    DatasetBase.__init__(dataset, validate=False, **splits)
+    return dataset
+
+
+def copy_dataset(dataset):
+    """Shallow copy whose split lists can be changed without affecting
+    ``dataset`` (Datum objects are immutable and shared)."""
+    dataset = copy.copy(dataset)
+    for split in SPLITS:
+        data_source = getattr(dataset, f"_{split}")
+        if data_source is not None:
+            setattr(dataset, f"_{split}", list(data_source))
+    return dataset
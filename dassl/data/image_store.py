@@ -0,0 +1,111 @@
+import os
+import os.path as osp
+import numpy as np
+from multiprocessing import Pool
+from PIL import Image
+from tqdm import tqdm
+
+from dassl.utils import read_image, mkdir_if_missing
+
+PIXELS_FILE = "pixels.u8"
+INDEX_FILE = "index.npz"
+
+_STORES = {}
+
+
+class ImageStore:
+    """Decoded RGB images kept as uint8 arrays in one memory-mapped file.
+
+    ``pixels.u8`` holds the raw (H, W, 3) pixels of every image back to back
+    and ``index.npz`` the image paths with their byte offset and shape. The
+    file is opened lazily in every process (and not pickled to data-loader
+    workers), so reading an image is a slice of the page cache instead of a
+    JPEG decode.
+
+    Args:
+        root (str): directory written by ``build_image_store``.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        index = np.load(osp.join(root, INDEX_FILE))
+        self.offsets = index["offsets"]
+        self.shapes = index["shapes"]
+        self.short_side = int(index["short_side"]) if "short_side" in index else None
+        self.index = {impath: i for i, impath in enumerate(index["impaths"].tolist())}
+        self._pixels = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, impath):
+        return impath in self.index
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pixels"] = None
+        return state
+
+    @property
+    def pixels(self):
+        if self._pixels is None:
+            self._pixels = np.memmap(osp.join(self.root, PIXELS_FILE), dtype=np.uint8, mode="r")
+        return self._pixels
+
+    def read(self, impath):
+        """Return the stored image as a PIL image, or None if it is not stored."""
+        i = self.index.get(impath)
+        if i is None:
+            return None
+        shape = self.shapes[i]
+        start = self.offsets[i]
+        array = self.pixels[start:start + int(np.prod(shape))].reshape(shape)
+        return Image.fromarray(array)
+
+
+def get_image_store(root):
+    """Return the ``ImageStore`` of ``root``, opened once per process."""
+    if root not in _STORES:
+        _STORES[root] = ImageStore(root)
+    return _STORES[root]
+
+
+def _load_resized(args):
+    impath, short_side = args
+    img = read_image(impath)
+    w, h = img.size
+    if min(w, h) > short_side:
+        scale = short_side / min(w, h)
+        img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+    return np.asarray(img, dtype=np.uint8)
+
+
+def build_image_store(impaths, root, short_side, num_workers=8):
+    """Decode ``impaths`` once, shrink them to a short side of ``short_side``
+    pixels (smaller images are kept as they are) and write them to ``root``.
+
+    ``short_side`` should be a bit larger than INPUT.SIZE so that random
+    crops and the test-time resize still have pixels to work with.
+    """
+    impaths = list(dict.fromkeys(impaths))
+    mkdir_if_missing(root)
+    # The index is written last, so a store is only picked up once complete
+    if osp.exists(osp.join(root, INDEX_FILE)):
+        os.remove(osp.join(root, INDEX_FILE))
+    offsets = np.zeros(len(impaths), dtype=np.int64)
+    shapes = np.zeros((len(impaths), 3), dtype=np.int32)
+    tmp = osp.join(root, PIXELS_FILE + ".tmp")
+    offset = 0
+    with open(tmp, "wb") as f, Pool(num_workers) as pool:
+        arrays = pool.imap(_load_resized, [(impath, short_side) for impath in impaths], chunksize=16)
+        for i, array in enumerate(tqdm(arrays, total=len(impaths))):
+            f.write(array.tobytes())
+            offsets[i] = offset
+            shapes[i] = array.shape
+            offset += array.size
+    os.replace(tmp, osp.join(root, PIXELS_FILE))
+    np.savez(
+        osp.join(root, INDEX_FILE), impaths=np.array(impaths), offsets=offsets, shapes=shapes,
+        short_side=np.int64(short_side)
+    )
+    print(f"Stored {len(impaths)} images ({offset / 2**30:.2f} GiB) in {root}")
@@ -3,6 +3,7 @@ import numpy as np
 import random
 from collections import defaultdict
 from torch.utils.data.sampler import Sampler, RandomSampler, SequentialSampler
+from torch.utils.data.distributed import DistributedSampler
 
 
 class RandomDomainSampler(Sampler):
@@ -201,5 +202,10 @@ def build_sampler(
     elif sampler_type == "RandomClassSampler":
         return RandomClassSampler(data_source, batch_size, n_ins)
 
+    elif sampler_type == "DistributedSampler":
+        # Call set_epoch() before every epoch to reshuffle
+        seed = cfg.SEED if cfg is not None and cfg.SEED >= 0 else 0
+        return DistributedSampler(data_source, shuffle=True, seed=seed)
+
     else:
         raise ValueError("Unknown sampler type: {}".format(sampler_type))
@@ -0,0 +1,373 @@
+"""
+Batched tensor versions of the transforms of transforms.py.
+
+Data-loader workers only decode an image and bring it to a fixed size as a
+uint8 tensor; cropping, flipping, RandAugment and normalization run on the
+collated batch, on the device of the model.
+"""
+import math
+import torch
+import torch.nn.functional as F
+from torchvision.ops import roi_align
+from torchvision.transforms import Resize, CenterCrop, PILToTensor, Compose
+from torchvision.transforms.functional import InterpolationMode
+
+from .randaugment import randaugment_list
+
+# Same as transforms.INTERPOLATION_MODES, which imports this module
+_INTERPOLATION_MODES = {
+    "bilinear": InterpolationMode.BILINEAR,
+    "bicubic": InterpolationMode.BICUBIC,
+    "nearest": InterpolationMode.NEAREST,
+}
+
+SUPPORTED_CHOICES = {
+    "random_resized_crop", "random_flip", "normalize", "randaugment",
+    "center_crop"
+}
+
+
+class SquashToTensor:
+    """Resize to a ``size`` x ``size`` uint8 tensor, ignoring the aspect
+    ratio, and keep the original size.
+
+    Squashing is an axis-aligned linear map, so a crop box given in original
+    pixels can still be cut out exactly after scaling its coordinates.
+    """
+
+    def __init__(self, size, interpolation):
+        self.size = size
+        self.resize = Resize((size, size), interpolation=interpolation)
+        self.to_tensor = PILToTensor()
+
+    def __call__(self, img):
+        w, h = img.size
+        img = self.resize(img)
+        return {"pixels": self.to_tensor(img), "size": torch.tensor([w, h])}
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(size={self.size})"
+
+
+class BatchTransform:
+    """Transform applied to a batch of uint8 images after collation.
+
+    ``sample_transform`` is what data-loader workers run per image; calling
+    the object on the collated output returns a float (B, 3, H, W) tensor.
+
+    Args:
+        cfg (CfgNode): config.
+        choices (list): names of the transforms, see ``SUPPORTED_CHOICES``.
+        is_train (bool): random augmentation (True) or resize + center crop.
+    """
+
+    def __init__(self, cfg, choices, is_train):
+        self.choices = list(choices)
+        self.is_train = is_train
+        self.input_size = tuple(cfg.INPUT.SIZE)
+        self.normalize = "normalize" in choices
+        self.mean = torch.tensor(cfg.INPUT.PIXEL_MEAN).view(1, 3, 1, 1)
+        self.std = torch.tensor(cfg.INPUT.PIXEL_STD).view(1, 3, 1, 1)
+        interp_mode = _INTERPOLATION_MODES[cfg.INPUT.INTERPOLATION]
+
+        if is_train:
+            self.scale = cfg.INPUT.RRCROP_SCALE
+            self.random_crop = "random_resized_crop" in choices
+            self.flip = "random_flip" in choices
+            self.randaugment = None
+            if "randaugment" in choices:
+                self.randaugment = BatchRandAugment(cfg.INPUT.RANDAUGMENT_N, cfg.INPUT.RANDAUGMENT_M)
+            # Squashing loses resolution along the long side, so keep a margin
+            size = cfg.INPUT.BATCH_TRANSFORMS_SIZE or int(max(self.input_size) * 1.5)
+            self.sample_transform = SquashToTensor(size, interp_mode)
+        else:
+            self.sample_transform = Compose([
+                Resize(max(self.input_size), interpolation=interp_mode),
+                CenterCrop(self.input_size),
+                PILToTensor(),
+            ])
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}(choices={self.choices}, is_train={self.is_train}, sample_transform={self.sample_transform})"
+
+    def __call__(self, img, device=None):
+        if isinstance(img, dict):
+            pixels, size = img["pixels"], img["size"]
+        else:
+            pixels, size = img, None
+        if device is not None:
+            pixels = pixels.to(device, non_blocking=True)
+        x = pixels.float()
+
+        if self.is_train:
+            x = self.crop(x, size)
+            if self.flip:
+                flip = torch.rand(x.shape[0], device=x.device) < 0.5
+                x = torch.where(flip[:, None, None, None], x.flip(-1), x)
+            if self.randaugment is not None:
+                x = self.randaugment(x)
+
+        x = x / 255
+        if self.normalize:
+            x = (x - self.mean.to(x.device)) / self.std.to(x.device)
+        return x
+
+    def crop(self, x, size):
+        """Random resized crop (or a plain resize) of every image to INPUT.SIZE."""
+        B, _, S, _ = x.shape
+        size = size.to(x.device, torch.float32)
+        W, H = size[:, 0], size[:, 1]
+        if self.random_crop:
+            x0, y0, w, h = random_resized_crop_params(W, H, self.scale)
+        else:
+            x0, y0, w, h = torch.zeros_like(W), torch.zeros_like(H), W, H
+        # Crop boxes in the coordinates of the squashed S x S image
+        sx, sy = S / W, S / H
+        boxes = torch.stack([
+            torch.arange(B, device=x.device, dtype=torch.float32),
+            x0 * sx, y0 * sy, (x0 + w) * sx, (y0 + h) * sy
+        ], dim=1)
+        # Adaptive sampling averages over every source pixel of an output
+        # pixel, which antialiases like PIL's resize
+        return roi_align(x, boxes, self.input_size, spatial_scale=1.0, sampling_ratio=-1, aligned=True)
+
+
+def random_resized_crop_params(W, H, scale, ratio=(3 / 4, 4 / 3), attempts=10):
+    """Vectorized ``RandomResizedCrop.get_params`` for images of sizes (W, H)."""
+    B = W.shape[0]
+    device = W.device
+    area = (W * H)[:, None]
+    target_area = area * torch.empty(B, attempts, device=device).uniform_(*scale)
+    log_ratio = torch.empty(B, attempts, device=device).uniform_(math.log(ratio[0]), math.log(ratio[1]))
+    aspect = torch.exp(log_ratio)
+    w = torch.sqrt(target_area * aspect).round()
+    h = torch.sqrt(target_area / aspect).round()
+    valid = (w > 0) & (h > 0) & (w <= W[:, None]) & (h <= H[:, None])
+    first = valid.float().argmax(1)
+    found = valid.any(1)
+    w = w.gather(1, first[:, None])[:, 0]
+    h = h.gather(1, first[:, None])[:, 0]
+
+    # Fallback to a central crop
+    in_ratio = W / H
+    fw = torch.where(in_ratio < ratio[0], W, torch.where(in_ratio > ratio[1], (H * ratio[1]).round(), W))
+    fh = torch.where(in_ratio < ratio[0], (W / ratio[0]).round(), torch.where(in_ratio > ratio[1], H, H))
+    w = torch.where(found, w, fw)
+    h = torch.where(found, h, fh)
+
+    x0 = torch.floor(torch.rand(B, device=device) * (W - w + 1))
+    y0 = torch.floor(torch.rand(B, device=device) * (H - h + 1))
+    x0 = torch.where(found, x0, ((W - w) / 2).round())
+    y0 = torch.where(found, y0, ((H - h) / 2).round())
+    return x0, y0, w, h
+
+
+def _grayscale(x):
+    return (0.299 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def _blend(degenerate, x, v):
+    return (degenerate + v * (x - degenerate)).clamp_(0, 255)
+
+
+def _random_sign(x, v):
+    sign = torch.where(torch.rand(x.shape[0], device=x.device) < 0.5, -1.0, 1.0)
+    return sign * v
+
+
+def _affine(x, matrix):
+    """Apply pixel-space affine maps (output -> input, (B, 2, 3)) with a
+    black fill, like ``PIL.Image.transform``."""
+    B, _, H, W = x.shape
+    # Pixel coordinates <-> normalized coordinates of affine_grid
+    to_pix = x.new_tensor([[W / 2, 0, W / 2 - 0.5], [0, H / 2, H / 2 - 0.5], [0, 0, 1]])
+    to_norm = torch.linalg.inv(to_pix)
+    full = torch.cat([matrix, x.new_tensor([0, 0, 1]).expand(B, 1, 3)], dim=1)
+    theta = (to_norm @ full @ to_pix)[:, :2]
+    grid = F.affine_grid(theta, x.shape, align_corners=False)
+    return F.grid_sample(x, grid, mode="nearest", padding_mode="zeros", align_corners=False)
+
+
+def _shear_x(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, torch.stack([torch.stack([one, v, zero], 1), torch.stack([zero, one, zero], 1)], 1))
+
+
+def _shear_y(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, torch.stack([torch.stack([one, zero, zero], 1), torch.stack([v, one, zero], 1)], 1))
+
+
+def _translate_x(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, torch.stack([torch.stack([one, zero, v], 1), torch.stack([zero, one, zero], 1)], 1))
+
+
+def _translate_y(x, v):
+    v = _random_sign(x, v)
+    one, zero = torch.ones_like(v), torch.zeros_like(v)
+    return _affine(x, torch.stack([torch.stack([one, zero, zero], 1), torch.stack([zero, one, v], 1)], 1))
+
+
+def _rotate(x, v):
+    H, W = x.shape[-2:]
+    angle = _random_sign(x, v) * math.pi / 180
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    cx, cy = (W - 1) / 2, (H - 1) / 2
+    # Rotation about the image center
+    row0 = torch.stack([cos, -sin, cx - cos * cx + sin * cy], 1)
+    row1 = torch.stack([sin, cos, cy - sin * cx - cos * cy], 1)
+    return _affine(x, torch.stack([row0, row1], 1))
+
+
+def _auto_contrast(x, v):
+    lo = x.amin(dim=(2, 3), keepdim=True)
+    hi = x.amax(dim=(2, 3), keepdim=True)
+    scale = 255 / (hi - lo).clamp(min=1)
+    return torch.where(hi > lo, (x - lo) * scale, x).floor_()
+
+
+def _equalize(x, v):
+    # Same lookup table as PIL.ImageOps.equalize, per image and channel
+    B, C, H, W = x.shape
+    flat = x.reshape(B * C, H * W).long().clamp_(0, 255)
+    hist = torch.zeros(B * C, 256, device=x.device).scatter_add_(1, flat, torch.ones_like(flat, dtype=torch.float32))
+    last_bin = (torch.arange(256, device=x.device) * (hist > 0)).argmax(1, keepdim=True)
+    step = torch.div(H * W - hist.gather(1, last_bin), 255, rounding_mode="floor")
+    cum = torch.cumsum(hist, 1) - hist
+    lut = torch.div(cum + torch.div(step, 2, rounding_mode="floor"), step.clamp(min=1), rounding_mode="floor").clamp_(max=255)
+    lut = torch.where(step > 0, lut, torch.arange(256, device=x.device, dtype=lut.dtype).expand_as(lut))
+    return lut.gather(1, flat).reshape(B, C, H, W)
+
+
+def _invert(x, v):
+    return 255 - x
+
+
+def _posterize(x, v):
+    shift = 2 ** (8 - int(v))
+    return torch.div(x.floor(), shift, rounding_mode="floor") * shift
+
+
+def _solarize(x, v):
+    return torch.where(x >= v, 255 - x, x)
+
+
+def _solarize_add(x, v):
+    return _solarize((x + int(v)).clamp(0, 255), 128)
+
+
+def _color(x, v):
+    return _blend(_grayscale(x), x, v)
+
+
+def _contrast(x, v):
+    mean = _grayscale(x).mean(dim=(1, 2, 3), keepdim=True).add_(0.5).floor_()
+    return _blend(mean, x, v)
+
+
+def _brightness(x, v):
+    return (x * v).clamp_(0, 255)
+
+
+def _sharpness(x, v):
+    kernel = x.new_tensor([[1, 1, 1], [1, 5, 1], [1, 1, 1]]) / 13
+    kernel = kernel.expand(x.shape[1], 1, 3, 3)
+    smooth = F.conv2d(x, kernel, padding=1, groups=x.shape[1]).round_()
+    # PIL keeps the border pixels
+    degenerate = x.clone()
+    degenerate[..., 1:-1, 1:-1] = smooth[..., 1:-1, 1:-1]
+    return _blend(degenerate, x, v)
+
+
+def _cutout(x, v):
+    if v <= 0:
+        return x
+    B, _, H, W = x.shape
+    cx = torch.rand(B, 1, 1, device=x.device) * W
+    cy = torch.rand(B, 1, 1, device=x.device) * H
+    x0 = (cx - v / 2).clamp(min=0).floor()
+    y0 = (cy - v / 2).clamp(min=0).floor()
+    xs = torch.arange(W, device=x.device).view(1, 1, W)
+    ys = torch.arange(H, device=x.device).view(1, H, 1)
+    mask = (xs >= x0) & (xs <= x0 + v) & (ys >= y0) & (ys <= y0 + v)
+    color = x.new_tensor([125, 123, 114]).view(1, 3, 1, 1)
+    return torch.where(mask.unsqueeze(1), color, x)
+
+
+_BATCH_OPS = {
+    "AutoContrast": _auto_contrast,
+    "Equalize": _equalize,
+    "Invert": _invert,
+    "Rotate": _rotate,
+    "Posterize": _posterize,
+    "Solarize": _solarize,
+    "SolarizeAdd": _solarize_add,
+    "Color": _color,
+    "Contrast": _contrast,
+    "Brightness": _brightness,
+    "Sharpness": _sharpness,
+    "ShearX": _shear_x,
+    "ShearY": _shear_y,
+    "CutoutAbs": _cutout,
+    "TranslateXabs": _translate_x,
+    "TranslateYabs": _translate_y,
+}
+
+
+class BatchRandAugment:
+    """``RandAugment`` on a float (B, 3, H, W) batch in [0, 255].
+
+    Every image draws its own ``n`` operations from ``randaugment_list``;
+    each operation is then applied once to the images that drew it.
+    """
+
+    def __init__(self, n=2, m=10):
+        assert 0 <= m <= 30
+        self.n = n
+        self.m = m
+        self.augment_list = [
+            (_BATCH_OPS[op.__name__], (m / 30) * (maxval - minval) + minval)
+            for op, minval, maxval in randaugment_list()
+        ]
+
+    def __call__(self, x):
+        for _ in range(self.n):
+            choice = torch.randint(len(self.augment_list), (x.shape[0],), device=x.device)
+            out = x.clone()
+            for k in choice.unique().tolist():
+                op, val = self.augment_list[k]
+                idx = (choice == k).nonzero()[:, 0]
+                out[idx] = op(x[idx], val)
+            x = out
+        return x
+
+
+class BatchTransformLoader:
+    """Iterates ``data_loader`` and applies ``transforms`` (output key ->
+    BatchTransform) to the collated images on ``device``. Other attributes
+    are those of the wrapped loader."""
+
+    def __init__(self, data_loader, transforms, device):
+        self.data_loader = data_loader
+        self.transforms = transforms
+        self.device = device
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __getattr__(self, name):
+        return getattr(self.data_loader, name)
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            for key, tfm in self.transforms.items():
+                img = batch[key]
+                if isinstance(img, list):  # K_TRANSFORMS > 1
+                    batch[key] = [tfm(im, self.device) for im in img]
+                else:
+                    batch[key] = tfm(img, self.device)
+            yield batch
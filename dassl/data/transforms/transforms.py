@@ -11,6 +11,7 @@ from torchvision.transforms.functional import InterpolationMode
 
 from .autoaugment import SVHNPolicy, CIFAR10Policy, ImageNetPolicy
 from .randaugment import RandAugment, RandAugment2, RandAugmentFixMatch
+from .batch_transforms import SUPPORTED_CHOICES, BatchTransform
 
 AVAI_CHOICES = [
     "random_flip",
@@ -195,6 +196,13 @@ def build_transform(cfg, is_train=True, choices=None):
 
     target_size = f"{cfg.INPUT.SIZE[0]}x{cfg.INPUT.SIZE[1]}"
 
+    if cfg.INPUT.BATCH_TRANSFORMS:
+        if set(choices) <= SUPPORTED_CHOICES:
+            print(f"Building batch transform ({'train' if is_train else 'test'})")
+            return BatchTransform(cfg, choices, is_train)
+        unsupported = sorted(set(choices) - SUPPORTED_CHOICES)
+        print(f"Note: no batch version of {unsupported}, using per-image transforms")
+
     normalize = Normalize(mean=cfg.INPUT.PIXEL_MEAN, std=cfg.INPUT.PIXEL_STD)
 
     if is_train:
@@ -460,6 +460,11 @@ class SimpleTrainer(TrainerBase):
 
         print(f"Evaluate on the *{split}* set")
 
+        # Prompt-based models have a fixed text side during evaluation, so
+        # encode it once instead of once per batch
+        if text_features is None and hasattr(self.get_inference_model(), "encode_text"):
+            text_features = self.get_inference_model().encode_text()
+
         for batch_idx, batch in enumerate(tqdm(data_loader)):
             input, label = self.parse_batch_test(batch)
             output = self.model_inference(input, text_features)
@@ -473,12 +478,19 @@ class SimpleTrainer(TrainerBase):
 
         return list(results.values())[0]
 
-    def model_inference(self, input, text_features):
-        if text_features is not None:
-            return self.model.forward_with_customized_text_feature(input, text_features)
-        else:
+    def model_inference(self, input, text_features=None):
+        # DataParallel would also split text_features along the class
+        # dimension, so its replicas encode the text side themselves
+        if text_features is None or isinstance(self.model, nn.DataParallel):
             return self.model(input)
-    
+        return self.model(input, text_features=text_features)
+
+    def get_inference_model(self):
+        """Return the model with any data-parallel wrapper removed."""
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            return self.model.module
+        return self.model
+
 
     def parse_batch_test(self, batch):
         input = batch["img"]
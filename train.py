@@ -1,4 +1,5 @@
 import argparse
+import os.path as osp
 import torch
 
 from dassl.utils import setup_logger, set_random_seed, collect_env_info
@@ -20,6 +21,7 @@ import datasets.ucf101
 
 
 import trainers.alvlm
+from trainers.distributed import init_distributed, get_rank
 
 
 def print_args(args, cfg):
@@ -88,6 +90,8 @@ def extend_cfg(cfg):
     cfg.TRAINER.COOP.PREC = "fp16"  # fp16, fp32, amp
     cfg.TRAINER.COOP.CLASS_TOKEN_POSITION = "end"  # 'middle' or 'end' or 'front'
     cfg.TRAINER.COOP.TRAIN_TYPE="freeze"
+    cfg.TRAINER.COOP.TEXT_TRUNCATE = False  # run the text encoder only up to the last EOT token
+    cfg.TRAINER.COOP.TEXT_BUCKETS = 1  # number of prompt-length buckets when truncating
     
     cfg.TRAINER.COCOOP = CN()
     cfg.TRAINER.COCOOP.N_CTX = 16  # number of context vectors
@@ -104,6 +108,16 @@ def extend_cfg(cfg):
     cfg.TRAINER.COOPAL.ASPATH = ""
     cfg.TRAINER.COOPAL.AEPATH = ""
     cfg.TRAINER.COOPAL.GAMMA = 0.1
+    cfg.TRAINER.COOPAL.BADGE_FACTORED = False  # keep BADGE gradient embeddings as (probs, features) factors
+    cfg.TRAINER.COOPAL.CORESET_METRIC = "euclidean"  # euclidean, sqeuclidean or cosine (normalized features)
+    cfg.TRAINER.COOPAL.CORESET_DTYPE = "fp32"  # storage type of Coreset features: fp32, fp16 or bf16
+    cfg.TRAINER.COOPAL.CORESET_MINDIST_CACHE = False  # keep labeled-to-unlabeled minima in a memmap under OUTPUT_DIR
+    cfg.TRAINER.COOPAL.FEATURE_CACHE = False  # reuse frozen image features across selectors and rounds
+    cfg.TRAINER.COOPAL.FEATURE_CACHE_DIR = "cache/features"  # "" keeps the cache in memory only
+    cfg.TRAINER.COOPAL.TOKEN_CACHE_DIR = ""  # store tokenized descriptor prompts on disk, "" = off
+    cfg.TRAINER.COOPAL.AUG_BANK_SIZE = 0  # augmented views per labeled image encoded once for training, 0 = train on images
+    cfg.TRAINER.COOPAL.UNCERTAINTY = "entropy"  # score of the entropy method: entropy, margin or least_confidence
+    cfg.TRAINER.COOPAL.SHARED_INFER_LOADER = True  # keep the workers of the selection loader alive across passes and rounds
     cfg.DATASET.SUBSAMPLE_CLASSES = "all"  # all, base or new
 
     cfg.TRAINER.MAPLE = CN()
@@ -142,11 +156,14 @@ def setup_cfg(args):
 
 
 def main(args):
+    # Launched with torchrun: one process per GPU, rank 0 writes the outputs
+    init_distributed()
     cfg = setup_cfg(args)
     if cfg.SEED >= 0:
         print("Setting fixed seed: {}".format(cfg.SEED))
         set_random_seed(cfg.SEED)
-    setup_logger(cfg.OUTPUT_DIR)
+    rank = get_rank()
+    setup_logger(cfg.OUTPUT_DIR if rank == 0 else osp.join(cfg.OUTPUT_DIR, f"rank{rank}"))
 
     if torch.cuda.is_available() and cfg.USE_CUDA:
         torch.backends.cudnn.benchmark = True
@@ -1,7 +1,15 @@
 import torch
+import torch.nn as nn
+
+from dassl.data.transforms.transforms import build_transform
+from dassl.data.data_manager import build_data_loader
+
+from ..distributed import get_world_size, shard_range, all_gather_rows
+from ..infer_loader import infer_batch_size
+
 
 class AL(object):
-    def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, **kwargs):
+    def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, feature_cache=None, infer_loader=None, **kwargs):
         self.unlabeled_dst = unlabeled_dst
         self.U_index = U_index
         self.unlabeled_set = torch.utils.data.Subset(unlabeled_dst, U_index)
@@ -10,6 +18,86 @@ class AL(object):
         self.model = model
         self.index = []
         self.cfg = cfg
+        self.feature_cache = feature_cache
+        self.infer_loader = infer_loader
+        self.predictions = None
+
+    @property
+    def clip_model(self):
+        if isinstance(self.model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            return self.model.module
+        return self.model
+
+    def get_outputs(self, data_source, feature_dtype=None):
+        """Return logits and normalized image features of ``data_source`` (in order).
+
+        When a feature cache is available the frozen image encoder is skipped
+        for every image it already holds. Outputs are written into
+        preallocated buffers; ``feature_dtype`` sets the storage type of the
+        features (e.g. torch.float16 to halve their memory). When running
+        distributed, every rank scores a contiguous shard and the shards are
+        all-gathered, so all ranks return the full outputs.
+        """
+        self.model.eval()
+        device = next(self.clip_model.parameters()).device
+        batch_size = infer_batch_size(self.cfg)
+        sharded = get_world_size() > 1 and len(data_source) >= get_world_size()
+        if sharded:
+            data_source = torch.utils.data.Subset(data_source, range(*shard_range(len(data_source))))
+        n = len(data_source)
+        logits, features = None, None
+        with torch.no_grad():
+            # The prompts are fixed while scoring, so the text side is encoded once
+            text_features = self.clip_model.encode_text()
+            for start, out, feat in self._iter_outputs(data_source, device, batch_size, text_features):
+                if logits is None:
+                    logits = torch.empty(n, out.shape[1], dtype=out.dtype, device=device)
+                    features = torch.empty(n, feat.shape[1], dtype=feature_dtype or feat.dtype, device=device)
+                logits[start:start + len(out)] = out
+                features[start:start + len(feat)] = feat
+        if sharded:
+            logits, features = all_gather_rows(logits), all_gather_rows(features)
+        return logits, features
+
+    def _iter_outputs(self, data_source, device, batch_size, text_features):
+        if self.feature_cache is not None:
+            image_features = self.feature_cache.get(self.clip_model, data_source, device, infer_loader=self.infer_loader)
+            for start in range(0, len(image_features), batch_size):
+                out, feat = self.clip_model.forward_features(
+                    image_features[start:start + batch_size], get_feature=True, text_features=text_features
+                )
+                yield start, out, feat
+        else:
+            loader = self.infer_loader.loader_for(data_source) if self.infer_loader is not None else None
+            if loader is None:
+                loader = build_data_loader(
+                    self.cfg,
+                    data_source=data_source,
+                    batch_size=batch_size,
+                    n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
+                    n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
+                    tfm=build_transform(self.cfg, is_train=False),
+                    is_train=False,
+                )
+            start = 0
+            for batch in loader:
+                inputs = batch["img"].to(device)
+                out, feat = self.clip_model(inputs, get_feature=True, text_features=text_features)
+                yield start, out, feat
+                start += len(inputs)
+
+    def store_predictions(self, logits):
+        """Keep the argmax prediction of every sample of ``self.unlabeled_set``
+        so that a follow-up selector (PCB) does not have to score them again."""
+        self.predictions = logits.argmax(1).cpu()
+
+    def get_predictions(self, Q_index):
+        """Return the stored predictions of the pool indices ``Q_index``, or
+        None if this selector has not scored the unlabeled set."""
+        if self.predictions is None:
+            return None
+        position = {idx: i for i, idx in enumerate(self.U_index)}
+        return self.predictions[[position[idx] for idx in Q_index]]
 
     def select(self, **kwargs):
-        return
\ No newline at end of file
+        return
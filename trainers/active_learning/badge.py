@@ -1,95 +1,43 @@
 import torch
 import numpy as np
-from sklearn.metrics import pairwise_distances
-import pdb
-from scipy import stats
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
 
 from .AL import AL
+from .grad_embedding import FactoredGradEmbedding
+from .kmeans_pp import k_means_plus_centers
 
 
 class BADGE(AL):
     def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, device, **kwargs):
         super().__init__(cfg, model, unlabeled_dst, U_index, n_class, **kwargs)
         self.device = device 
-        self.pred = []
         
     def get_grad_features(self):
-        self.pred = []
         self.model.eval()
-        # embDim = self.model.image_encoder.attnpool.c_proj.out_features
-        if self.cfg.MODEL.BACKBONE.NAME != "RN50":
-            embDim = 512
-        else:
-            embDim = 1024
         num_unlabeled = len(self.U_index)
         assert len(self.unlabeled_set) == num_unlabeled, f"{len(self.unlabeled_dst)} != {num_unlabeled}"
-        grad_embeddings = torch.zeros([num_unlabeled, embDim * self.n_class])
-        with torch.no_grad():
-            unlabeled_loader = build_data_loader(
-                self.cfg,
-                data_source=self.unlabeled_set,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            # unlabeled_loader = torch.utils.data.DataLoader(self.unlabeled_set, batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-            #                                                num_workers=self.cfg.DATALOADER.NUM_WORKERS)
-            # generate entire unlabeled features set
-            for i, batch in enumerate(unlabeled_loader):
-                inputs = batch["img"].to(self.device)
-                out, features = self.model(inputs, get_feature=True)
-                batchProbs = torch.nn.functional.softmax(out, dim=1).data
-                maxInds = torch.argmax(batchProbs, 1)
-                # _, preds = torch.max(out.data, 1)
-                self.pred.append(maxInds.detach().cpu())
+        out, features = self.get_outputs(self.unlabeled_set)
+        self.store_predictions(out)
+        embDim = features.shape[1]
+        batchProbs = torch.nn.functional.softmax(out, dim=1).data
+        maxInds = torch.argmax(batchProbs, 1)
 
-                for j in range(len(inputs)):
-                    for c in range(self.n_class):
-                        if c == maxInds[j]:
-                            grad_embeddings[i * len(inputs) + j][embDim * c: embDim * (c + 1)] = features[j].clone() * (
-                                        1 - batchProbs[j][c])
-                        else:
-                            grad_embeddings[i * len(inputs) + j][embDim * c: embDim * (c + 1)] = features[j].clone() * (
-                                        -1 * batchProbs[j][c])
-        return grad_embeddings.cpu().numpy()
+        # g = (onehot(argmax) - p) (x) feature, i.e. the gradient of the CE loss
+        # w.r.t. the last layer, filled one batch of rows at a time
+        coef = torch.nn.functional.one_hot(maxInds, self.n_class).to(batchProbs.dtype) - batchProbs
+        if self.cfg.TRAINER.COOPAL.BADGE_FACTORED:
+            return FactoredGradEmbedding(coef, features)
 
-    # kmeans ++ initialization
-    def k_means_plus_centers(self, X, K):
-        ind = np.argmax([np.linalg.norm(s, 2) for s in X])
-        mu = [X[ind]]
-        indsAll = [ind]
-        centInds = [0.] * len(X)
-        cent = 0
-        print('#Samps\tTotal Distance')
-        while len(mu) < K:
-            if len(mu) == 1:
-                D2 = pairwise_distances(X, mu).ravel().astype(float)
-            else:
-                newD = pairwise_distances(X, [mu[-1]]).ravel().astype(float)
-                for i in range(len(X)):
-                    if D2[i] > newD[i]:
-                        centInds[i] = cent
-                        D2[i] = newD[i]
-            if len(mu) % 100 == 0:
-                print(str(len(mu)) + '\t' + str(sum(D2)), flush=True)
-            if sum(D2) == 0.0: pdb.set_trace()
-            D2 = D2.ravel().astype(float)
-            Ddist = (D2 ** 2) / sum(D2 ** 2)
-            customDist = stats.rv_discrete(name='custm', values=(np.arange(len(D2)), Ddist))
-            ind = customDist.rvs(size=1)[0]
-            while ind in indsAll: ind = customDist.rvs(size=1)[0]
-            mu.append(X[ind])
-            indsAll.append(ind)
-            cent += 1
-        return indsAll
+        grad_embeddings = torch.zeros([num_unlabeled, embDim * self.n_class])
+        grad_view = grad_embeddings.view(num_unlabeled, self.n_class, embDim)
+        batch_size = self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE
+        for start in range(0, num_unlabeled, batch_size):
+            end = start + batch_size
+            grad_view[start:end] = (features[start:end, None, :] * coef[start:end, :, None]).cpu()
+        return grad_embeddings.cpu().numpy()
 
     def select(self, n_query, **kwargs):
         unlabeled_features = self.get_grad_features()
-        selected_indices = self.k_means_plus_centers(X=unlabeled_features, K=n_query)
+        selected_indices = k_means_plus_centers(unlabeled_features, n_query, seed=self.cfg.SEED)
         scores = list(np.ones(len(selected_indices))) # equally assign 1 (meaningless)
 
         Q_index = [self.U_index[idx] for idx in selected_indices]
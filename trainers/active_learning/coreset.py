@@ -1,9 +1,48 @@
 from .AL import AL
+from .kcenter import k_center_greedy, labeled_min_dist
+from ..distributed import is_main_process, broadcast_object, barrier
+import hashlib
+import os.path as osp
 import torch
 import numpy as np
 
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
+from dassl.utils import mkdir_if_missing
+
+FEATURE_DTYPES = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+class MinDistStore:
+    """Memory-mapped nearest-labeled distance of every sample of the pool.
+
+    Image features are frozen, so the minimum over the labeled set only has
+    to be updated with the samples labeled since the previous round.
+    ``folded`` marks the pool samples already taken into account. A stored
+    file is only reused if every folded sample is in ``labeled_index``;
+    otherwise it belongs to another run and is rebuilt.
+    """
+
+    def __init__(self, path, n, labeled_index):
+        folded_path = path[:-len(".npy")] + "_folded.npy"
+        if osp.exists(path) and osp.exists(folded_path):
+            self.min_dist = np.load(path, mmap_mode="r+")
+            self.folded = np.load(folded_path, mmap_mode="r+")
+            labeled = np.zeros(n, dtype=bool)
+            labeled[labeled_index] = True
+            if len(self.min_dist) == n and len(self.folded) == n and not (self.folded & ~labeled).any():
+                return
+            print(f"{path} does not match the labeled set, rebuilding it")
+            self.min_dist, self.folded = None, None
+        mkdir_if_missing(osp.dirname(path))
+        self.min_dist = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n,))
+        self.min_dist[:] = np.inf
+        self.folded = np.lib.format.open_memmap(folded_path, mode="w+", dtype=bool, shape=(n,))
+        self.folded[:] = False
+
+    def update(self, index, min_dist, newly_folded):
+        self.min_dist[index] = min_dist
+        self.folded[newly_folded] = True
+        self.min_dist.flush()
+        self.folded.flush()
 
 
 class Coreset(AL):
@@ -12,82 +51,55 @@ class Coreset(AL):
         # self.I_index = I_index
         # self.labeled_in_set = torch.utils.data.Subset(self.unlabeled_dst, self.I_index)
         self.labeled_in_set = val_set
+        self.feature_dtype = FEATURE_DTYPES[cfg.TRAINER.COOPAL.CORESET_DTYPE]
         
-    def get_features(self):
+    def get_features(self, labeled_in_set=None):
+        if labeled_in_set is None:
+            labeled_in_set = self.labeled_in_set
         self.model.eval()
-        labeled_features, unlabeled_features = None, None
-        with torch.no_grad():
-            labeled_in_loader = build_data_loader(
-                self.cfg,
-                data_source=self.labeled_in_set, 
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            unlabeled_loader = build_data_loader(
-                self.cfg,
-                data_source=self.unlabeled_set,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            # labeled_in_loader = torch.utils.data.DataLoader(self.labeled_in_set, batch_size=self.args.test_batch_size, num_workers=self.args.workers)
-            # unlabeled_loader = torch.utils.data.DataLoader(self.unlabeled_set, batch_size=self.args.test_batch_size, num_workers=self.args.workers)
-
-            # generate entire labeled_in features set
-            for data in labeled_in_loader:
-                inputs = data["img"].cuda()
-                out, features = self.model(inputs, get_feature=True)
-
-                if labeled_features is None:
-                    labeled_features = features
-                else:
-                    labeled_features = torch.cat((labeled_features, features), 0)
-
-            # generate entire unlabeled features set
-            for data in unlabeled_loader:
-                inputs = data["img"].cuda()
-                out, features = self.model(inputs, get_feature=True)
-                if unlabeled_features is None:
-                    unlabeled_features = features
-                else:
-                    unlabeled_features = torch.cat((unlabeled_features, features), 0)
+        _, labeled_features = self.get_outputs(labeled_in_set, feature_dtype=self.feature_dtype)
+        unlabeled_logits, unlabeled_features = self.get_outputs(self.unlabeled_set, feature_dtype=self.feature_dtype)
+        self.store_predictions(unlabeled_logits)
         return labeled_features, unlabeled_features
 
-    def k_center_greedy(self, labeled, unlabeled, n_query):
-        # get the minimum distances between the labeled and unlabeled examples (iteratively, to avoid memory issues):
-        min_dist = torch.min(torch.cdist(labeled[0:2, :], unlabeled), 0).values
-        for j in range(2, labeled.shape[0], 100):
-            if j + 100 < labeled.shape[0]:
-                dist_matrix = torch.cdist(labeled[j:j + 100, :], unlabeled)
-            else:
-                dist_matrix = torch.cdist(labeled[j:, :], unlabeled)
-            min_dist = torch.stack((min_dist, torch.min(dist_matrix, 0).values))
-            min_dist = torch.min(min_dist, 0).values
-
-        min_dist = min_dist.reshape((1, min_dist.size(0)))
-        farthest = torch.argmax(min_dist)
-
-        greedy_indices = torch.tensor([farthest])
-        for i in range(n_query - 1):
-            dist_matrix = torch.cdist(unlabeled[greedy_indices[-1], :].reshape((1, -1)), unlabeled)
-            min_dist = torch.stack((min_dist, dist_matrix))
-            min_dist = torch.min(min_dist, 0).values
-
-            farthest = torch.tensor([torch.argmax(min_dist)])
-            greedy_indices = torch.cat((greedy_indices, farthest), 0)
-
-        return greedy_indices.cpu().numpy()
+    def store_key(self):
+        """Hash of the settings the stored distances depend on."""
+        cfg = self.cfg
+        key = "|".join([
+            cfg.MODEL.BACKBONE.NAME, cfg.TRAINER.COOP.PREC, cfg.TRAINER.COOPAL.CORESET_DTYPE,
+            cfg.DATALOADER.IMAGE_STORE,
+        ])
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()[:8]
 
     def select(self, n_query, **kwargs):
-        labeled_features, unlabeled_features = self.get_features()
-        selected_indices = self.k_center_greedy(labeled_features, unlabeled_features, n_query)
+        metric = self.cfg.TRAINER.COOPAL.CORESET_METRIC
+        if not self.cfg.TRAINER.COOPAL.CORESET_MINDIST_CACHE:
+            labeled_features, unlabeled_features = self.get_features()
+            selected_indices = k_center_greedy(labeled_features, unlabeled_features, n_query, metric=metric)
+        else:
+            pool_index = {item.impath: i for i, item in enumerate(self.unlabeled_dst)}
+            labeled_index = [pool_index[item.impath] for item in self.labeled_in_set]
+            # Only rank 0 opens the files, the other ranks get the stored minima from it
+            store, new_index = None, None
+            if is_main_process():
+                store = MinDistStore(
+                    osp.join(self.cfg.OUTPUT_DIR, f"coreset_min_dist_{metric}_{self.store_key()}.npy"),
+                    len(self.unlabeled_dst), labeled_index
+                )
+                new_index = [i for i in labeled_index if not store.folded[i]]
+                print(f"Folding {len(new_index)} newly labeled samples into the stored distances")
+            new_index = broadcast_object(new_index)
+
+            labeled_features, unlabeled_features = self.get_features([self.unlabeled_dst[i] for i in new_index])
+            stored = broadcast_object(np.array(store.min_dist[self.U_index]) if store is not None else None)
+            min_dist = torch.from_numpy(stored).to(unlabeled_features.device)
+            torch.minimum(min_dist, labeled_min_dist(labeled_features, unlabeled_features, metric), out=min_dist)
+            if store is not None:
+                store.update(self.U_index, min_dist.cpu().numpy(), new_index)
+            barrier()
+            selected_indices = k_center_greedy(None, unlabeled_features, n_query, metric=metric, min_dist=min_dist)
         scores = list(np.ones(len(selected_indices))) # equally assign 1 (meaningless)
 
         Q_index = [self.U_index[idx] for idx in selected_indices]
 
-        return Q_index
\ No newline at end of file
+        return Q_index
@@ -1,10 +1,9 @@
 from .AL import AL
+from .kcenter import k_center_greedy
+from .coreset import FEATURE_DTYPES
 import torch
 import numpy as np
 
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
-
 
 class Coreset(AL):
     def __init__(self, cfg, model, unlabeled_dst, U_index, val_set, n_class, **kwargs):
@@ -15,110 +14,30 @@ class Coreset(AL):
         
     def get_features(self):
         self.model.eval()
-        labeled_features, unlabeled_features = None, None
-
-        if torch.cuda.device_count() > 1:
-            prompts = self.model.module.prompt_learner()
-            tokenized_prompts= self.model.module.tokenized_prompts
-            text_features = self.model.module.text_encoder(prompts, tokenized_prompts)
-            logit_scale = self.model.module.logit_scale.exp()
-            n_class_desc = self.model.module.n_class_desc
-            weighted_sum_weight = self.model.module.weighted_sum.w.detach()
-        else:
-            prompts = self.model.prompt_learner()
-            tokenized_prompts = self.model.tokenized_prompts
-            text_features = self.model.text_encoder(prompts, tokenized_prompts)
-            logit_scale = self.model.logit_scale.exp()
-            n_class_desc = self.model.n_class_desc
-            weighted_sum_weight = self.model.weighted_sum.w.detach()
-
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
-
-        softmaxed_weight = []
-        start = 0
-        for n in n_class_desc:
-            same_class_softmaxed_weight = torch.nn.functional.softmax(weighted_sum_weight[start: start + n], dim=0)
-            softmaxed_weight.extend(same_class_softmaxed_weight)
-            start += n
-        softmaxed_weight = torch.tensor(softmaxed_weight, device=text_features.device)
 
         with torch.no_grad():
-            labeled_in_loader = build_data_loader(
-                self.cfg,
-                data_source=self.labeled_in_set, 
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            unlabeled_loader = build_data_loader(
-                self.cfg,
-                data_source=self.unlabeled_set,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            # labeled_in_loader = torch.utils.data.DataLoader(self.labeled_in_set, batch_size=self.args.test_batch_size, num_workers=self.args.workers)
-            # unlabeled_loader = torch.utils.data.DataLoader(self.unlabeled_set, batch_size=self.args.test_batch_size, num_workers=self.args.workers)
-
-            # generate entire labeled_in features set
-            for data in labeled_in_loader:
-                inputs = data["img"].cuda()
-                out, features = self.model(inputs, get_feature=True)
-
-                if labeled_features is None:
-                    labeled_features = features
-                else:
-                    labeled_features = torch.cat((labeled_features, features), 0)
+            text_features = self.clip_model.encode_text()
+        logit_scale = self.clip_model.logit_scale.exp()
+        softmaxed_weight = self.clip_model.weighted_sum.softmaxed_weight().detach().float().to(text_features.device)
 
-            # generate entire unlabeled features set
-            for data in unlabeled_loader:
-                inputs = data["img"].cuda()
-                out, features = self.model(inputs, get_feature=True)
-                if unlabeled_features is None:
-                    unlabeled_features = features
-                else:
-                    unlabeled_features = torch.cat((unlabeled_features, features), 0)
+        _, labeled_features = self.get_outputs(self.labeled_in_set)
+        unlabeled_logits, unlabeled_features = self.get_outputs(self.unlabeled_set)
+        self.store_predictions(unlabeled_logits)
 
         labeled_features = (logit_scale * labeled_features @ text_features.t()) * softmaxed_weight
         unlabeled_features = (logit_scale * unlabeled_features @ text_features.t()) * softmaxed_weight
 
-        labeled_features = labeled_features.float()
-        unlabeled_features = unlabeled_features.float()
+        feature_dtype = FEATURE_DTYPES[self.cfg.TRAINER.COOPAL.CORESET_DTYPE]
+        labeled_features = labeled_features.to(feature_dtype)
+        unlabeled_features = unlabeled_features.to(feature_dtype)
 
         return labeled_features, unlabeled_features
 
-    def k_center_greedy(self, labeled, unlabeled, n_query):
-        # get the minimum distances between the labeled and unlabeled examples (iteratively, to avoid memory issues):
-        min_dist = torch.min(torch.cdist(labeled[0:2, :], unlabeled), 0).values
-        for j in range(2, labeled.shape[0], 100):
-            if j + 100 < labeled.shape[0]:
-                dist_matrix = torch.cdist(labeled[j:j + 100, :], unlabeled)
-            else:
-                dist_matrix = torch.cdist(labeled[j:, :], unlabeled)
-            min_dist = torch.stack((min_dist, torch.min(dist_matrix, 0).values))
-            min_dist = torch.min(min_dist, 0).values
-
-        min_dist = min_dist.reshape((1, min_dist.size(0)))
-        farthest = torch.argmax(min_dist)
-
-        greedy_indices = torch.tensor([farthest])
-        for i in range(n_query - 1):
-            dist_matrix = torch.cdist(unlabeled[greedy_indices[-1], :].reshape((1, -1)), unlabeled)
-            min_dist = torch.stack((min_dist, dist_matrix))
-            min_dist = torch.min(min_dist, 0).values
-
-            farthest = torch.tensor([torch.argmax(min_dist)])
-            greedy_indices = torch.cat((greedy_indices, farthest), 0)
-
-        return greedy_indices.cpu().numpy()
-
     def select(self, n_query, **kwargs):
         labeled_features, unlabeled_features = self.get_features()
-        selected_indices = self.k_center_greedy(labeled_features, unlabeled_features, n_query)
+        selected_indices = k_center_greedy(
+            labeled_features, unlabeled_features, n_query, metric=self.cfg.TRAINER.COOPAL.CORESET_METRIC
+        )
         scores = list(np.ones(len(selected_indices))) # equally assign 1 (meaningless)
 
         Q_index = [self.U_index[idx] for idx in selected_indices]
@@ -1,45 +1,22 @@
-import torch
-import numpy as np
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
-
 from .AL import AL
+from .uncertainty import uncertainty_scores, most_uncertain
 
 class Entropy(AL):
     def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, device, **kwargs):
         super().__init__(cfg, model, unlabeled_dst, U_index, n_class, **kwargs)
         self.device= device 
+        self.measure = cfg.TRAINER.COOPAL.UNCERTAINTY
         
     def run(self, n_query):
         scores = self.rank_uncertainty()
-        selection_result = np.argsort(scores)[:n_query]
+        selection_result = most_uncertain(scores, n_query)
         return selection_result, scores
 
     def rank_uncertainty(self):
-        self.model.eval()
-        with torch.no_grad():
-            # selection_loader = torch.utils.data.DataLoader(self.unlabeled_set, batch_size=self.args.test_batch_size, num_workers=self.args.workers)
-            selection_loader = build_data_loader(
-                self.cfg, 
-                data_source=self.unlabeled_set, 
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            scores = np.array([])
-            
-            print("| Calculating uncertainty of Unlabeled set")
-            for i, data in enumerate(selection_loader):
-                inputs = data["img"].to(self.device)
-                
-                preds = self.model(inputs, get_feature=False)
-                preds = torch.nn.functional.softmax(preds, dim=1).cpu().numpy()
-                entropys = (np.log(preds + 1e-6) * preds).sum(axis=1)
-                scores = np.append(scores, entropys)
-                
-        return scores
+        print(f"| Calculating uncertainty ({self.measure}) of Unlabeled set")
+        logits, _ = self.get_outputs(self.unlabeled_set)
+        self.store_predictions(logits)
+        return uncertainty_scores(logits, self.measure)
 
     def select(self, n_query, **kwargs):
         selected_indices, scores = self.run(n_query)
@@ -0,0 +1,63 @@
+import torch
+
+
+class FactoredGradEmbedding:
+    """BADGE gradient embeddings kept as their two factors.
+
+    Every embedding is an outer product g_i = a_i (x) x_i of a coefficient
+    vector a_i (onehot - probs, optionally scaled per descriptor) and an
+    image feature x_i. The dense N x (C*D) matrix is never built, since
+
+        <g_i, g_j> = <a_i, a_j> * <x_i, x_j>
+
+    so squared distances only need the N x C and N x D factors.
+
+    Args:
+        coef (torch.Tensor): coefficients of shape (N, C).
+        features (torch.Tensor): image features of shape (N, D).
+    """
+
+    def __init__(self, coef, features):
+        assert coef.shape[0] == features.shape[0]
+        self.coef = coef.float()
+        self.features = features.float()
+        self.sq_norms = (self.coef ** 2).sum(1) * (self.features ** 2).sum(1)
+
+    def __len__(self):
+        return self.coef.shape[0]
+
+    @property
+    def device(self):
+        return self.coef.device
+
+    def sq_dists_to(self, ind):
+        """Squared distances from every embedding to embedding ``ind``."""
+        dot = (self.coef @ self.coef[ind]) * (self.features @ self.features[ind])
+        return (self.sq_norms + self.sq_norms[ind] - 2 * dot).clamp_(min=0)
+
+
+class DenseGradEmbedding:
+    """Dense gradient embeddings with the same interface as
+    :class:`FactoredGradEmbedding`.
+
+    Args:
+        X (np.ndarray or torch.Tensor): embeddings of shape (N, E).
+    """
+
+    def __init__(self, X):
+        if not isinstance(X, torch.Tensor):
+            X = torch.from_numpy(X)
+        self.X = X.float()
+        self.sq_norms = (self.X ** 2).sum(1)
+
+    def __len__(self):
+        return self.X.shape[0]
+
+    @property
+    def device(self):
+        return self.X.device
+
+    def sq_dists_to(self, ind):
+        """Squared distances from every embedding to embedding ``ind``."""
+        dot = self.X @ self.X[ind]
+        return (self.sq_norms + self.sq_norms[ind] - 2 * dot).clamp_(min=0)
@@ -0,0 +1,89 @@
+import os
+
+import torch
+
+
+def pairwise_distances(x, y, metric="euclidean"):
+    """Distances between the rows of ``x`` and ``y``.
+
+    "sqeuclidean" and "cosine" give the same k-center ordering as
+    "euclidean" (the latter only for L2-normalized features) while
+    avoiding the square root of cdist.
+    """
+    if metric == "euclidean":
+        return torch.cdist(x, y)
+    elif metric == "sqeuclidean":
+        sq = (x * x).sum(1, keepdim=True) + (y * y).sum(1)[None, :] - 2 * (x @ y.t())
+        return sq.clamp_(min=0)
+    elif metric == "cosine":
+        return 1 - x @ y.t()
+    else:
+        raise ValueError(f"Unknown metric: {metric}")
+
+
+def auto_block_size(n_rows, n_cols, element_size=4, fraction=0.25):
+    """Number of rows of an (n_rows x n_cols) distance matrix that fit in a
+    ``fraction`` of the currently available memory."""
+    if torch.cuda.is_available():
+        free = torch.cuda.mem_get_info()[0]
+    else:
+        try:
+            free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        except (ValueError, OSError, AttributeError):
+            free = 1 << 30
+    block = int(free * fraction) // max(1, n_cols * element_size)
+    return max(1, min(n_rows, block))
+
+
+def labeled_min_dist(labeled, unlabeled, metric="euclidean", block_size=None):
+    """Distance from every unlabeled sample to its nearest labeled sample.
+
+    The distance matrix is computed in blocks of ``block_size`` labeled rows,
+    chosen from the available memory if None.
+    """
+    min_dist = torch.full((unlabeled.shape[0],), float("inf"), device=unlabeled.device)
+    if labeled is None or labeled.shape[0] == 0:
+        return min_dist
+    if block_size is None:
+        block_size = auto_block_size(labeled.shape[0], unlabeled.shape[0], element_size=unlabeled.element_size())
+    for j in range(0, labeled.shape[0], block_size):
+        dist = pairwise_distances(labeled[j:j + block_size], unlabeled, metric)
+        torch.minimum(min_dist, dist.min(0).values.float(), out=min_dist)
+    return min_dist
+
+
+def k_center_greedy(labeled, unlabeled, n_query, metric="euclidean", block_size=None, min_dist=None):
+    """Greedy k-center selection.
+
+    Picks ``n_query`` rows of ``unlabeled`` one at a time, each being the
+    point farthest from the labeled set and all points picked so far.
+
+    Args:
+        labeled (torch.Tensor): features of labeled samples (L, D), may be empty.
+        unlabeled (torch.Tensor): features of unlabeled samples (N, D).
+        n_query (int): number of samples to pick.
+        metric (str): "euclidean", "sqeuclidean" or "cosine".
+        block_size (int): labeled rows per distance block; chosen from the
+            available memory if None.
+        min_dist (torch.Tensor): precomputed labeled-to-unlabeled minima (N,);
+            ``labeled`` is ignored when given.
+
+    Returns:
+        np.ndarray of indices into ``unlabeled``.
+    """
+    n = unlabeled.shape[0]
+    device = unlabeled.device
+    if min_dist is None:
+        min_dist = labeled_min_dist(labeled, unlabeled, metric, block_size)
+    else:
+        min_dist = min_dist.to(device=device, dtype=torch.float32).clone()
+
+    n_query = min(n_query, n)
+    greedy_indices = torch.empty(n_query, dtype=torch.long, device=device)
+    for i in range(n_query):
+        farthest = torch.argmax(min_dist)
+        greedy_indices[i] = farthest
+        dist = pairwise_distances(unlabeled[farthest].unsqueeze(0), unlabeled, metric)[0]
+        torch.minimum(min_dist, dist.float(), out=min_dist)
+
+    return greedy_indices.cpu().numpy()
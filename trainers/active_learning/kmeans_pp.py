@@ -0,0 +1,54 @@
+import torch
+
+from .grad_embedding import FactoredGradEmbedding, DenseGradEmbedding
+
+
+def k_means_plus_centers(X, K, seed=-1):
+    """k-means++ seeding (as used by BADGE).
+
+    The first centre is the embedding with the largest norm. Every further
+    centre is drawn with probability proportional to the squared distance
+    to its nearest centre. The nearest-centre distances are updated in place
+    after each pick, so each step costs one matrix-vector product.
+
+    Args:
+        X (np.ndarray, torch.Tensor or FactoredGradEmbedding): embeddings.
+        K (int): number of centres to pick.
+        seed (int): seed of the sampler; negative values draw a random seed.
+
+    Returns:
+        list of indices into ``X``.
+    """
+    if not isinstance(X, (FactoredGradEmbedding, DenseGradEmbedding)):
+        X = DenseGradEmbedding(X)
+    n = len(X)
+    K = min(K, n)
+
+    generator = torch.Generator(device=X.device)
+    if seed >= 0:
+        generator.manual_seed(seed)
+    else:
+        generator.seed()
+
+    ind = int(torch.argmax(X.sq_norms))
+    indsAll = [ind]
+    chosen = torch.zeros(n, dtype=torch.bool, device=X.device)
+    chosen[ind] = True
+    min_sq_dist = X.sq_dists_to(ind)
+
+    print('#Samps\tTotal Distance')
+    while len(indsAll) < K:
+        if len(indsAll) % 100 == 0:
+            print(str(len(indsAll)) + '\t' + str(min_sq_dist.sqrt().sum().item()), flush=True)
+
+        weight = min_sq_dist.masked_fill(chosen, 0)
+        if weight.sum() <= 0:
+            # Every remaining point coincides with a centre: pick uniformly
+            weight = (~chosen).float()
+        ind = int(torch.multinomial(weight, 1, generator=generator))
+
+        indsAll.append(ind)
+        chosen[ind] = True
+        torch.minimum(min_sq_dist, X.sq_dists_to(ind), out=min_sq_dist)
+
+    return indsAll
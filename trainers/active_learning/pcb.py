@@ -1,68 +1,60 @@
-import torch
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
+import heapq
 import random
 
 from .AL import AL
 
 
 class PCB(AL):
-    def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, statistics, device, **kwargs):
+    def __init__(self, cfg, model, unlabeled_dst, U_index, n_class, statistics, device, pred=None, **kwargs):
         super().__init__(cfg, model, unlabeled_dst, U_index, n_class, **kwargs)
         self.device = device 
-        self.pred = []
+        self.pred = pred  # predictions of U_index from the previous selector, if any
         self.statistics = statistics 
 
     def select(self, n_query, **kwargs):
-        self.pred = []
-        self.model.eval()
-        # embDim = self.model.image_encoder.attnpool.c_proj.out_features
-        num_unlabeled = len(self.U_index)
-        assert len(self.unlabeled_set) == num_unlabeled, f"{len(self.unlabeled_dst)} != {num_unlabeled}"
-        with torch.no_grad():
-            unlabeled_loader = build_data_loader(
-                self.cfg,
-                data_source=self.unlabeled_set,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-            
-            # generate entire unlabeled features set
-            for i, batch in enumerate(unlabeled_loader):
-                inputs = batch["img"].to(self.device)
-                out, features = self.model(inputs, get_feature=True)
-                batchProbs = torch.nn.functional.softmax(out, dim=1).data
-                maxInds = torch.argmax(batchProbs, 1)
-                # _, preds = torch.max(out.data, 1)
-                self.pred.append(maxInds.detach().cpu())
-        self.pred = torch.cat(self.pred)
+        if self.pred is None:
+            self.model.eval()
+            num_unlabeled = len(self.U_index)
+            assert len(self.unlabeled_set) == num_unlabeled, f"{len(self.unlabeled_dst)} != {num_unlabeled}"
+            out, _ = self.get_outputs(self.unlabeled_set)
+            self.store_predictions(out)
+            self.pred = self.predictions
+        assert len(self.pred) == len(self.U_index), f"{len(self.pred)} != {len(self.U_index)}"
+
+        Q_index = self.balanced_sample(self.pred.tolist(), n_query)
+        Q_index = [self.U_index[idx] for idx in Q_index]
         
+        return Q_index
+
+    def balanced_sample(self, pred, n_query):
+        """Pick ``n_query`` positions of ``pred``, one at a time from the class
+        with the fewest labeled samples so far (lowest class id on ties).
+
+        Candidates are bucketed by predicted class once and shuffled, so each
+        pick pops from a queue instead of rescanning the predictions. Once the
+        rarest class has no candidates left its count stops changing, so the
+        remaining picks are drawn uniformly from the unselected samples.
+        """
+        n_query = min(n_query, len(pred))
+        buckets = [[] for _ in range(len(self.statistics))]
+        for idx, cls in enumerate(pred):
+            buckets[cls].append(idx)
+        for bucket in buckets:
+            random.shuffle(bucket)
+
+        counts = [(float(count), cls) for cls, count in enumerate(self.statistics.tolist())]
+        heapq.heapify(counts)
         Q_index = []
-        
         while len(Q_index) < n_query:
-            min_cls = int(torch.argmin(self.statistics))
-            sub_pred = (self.pred == min_cls).nonzero().squeeze(dim=1).tolist()
-            if len(sub_pred) == 0:
-                num = random.randint(0, num_unlabeled-1)
-                while num in Q_index:
-                    num = random.randint(0, num_unlabeled-1)
-                Q_index.append(num)
-            else:
-                random.shuffle(sub_pred)
-                for idx in sub_pred:
-                    if idx not in Q_index:
-                        Q_index.append(idx)
-                        self.statistics[min_cls] += 1
-                        break 
-                else: 
-                    num = random.randint(0, num_unlabeled-1)
-                    while num in Q_index:
-                        num = random.randint(0, num_unlabeled-1)
-                    Q_index.append(num)
-            
-        Q_index = [self.U_index[idx] for idx in Q_index]
-        
-        return Q_index
\ No newline at end of file
+            count, min_cls = counts[0]
+            if not buckets[min_cls]:
+                break
+            Q_index.append(buckets[min_cls].pop())
+            self.statistics[min_cls] += 1
+            heapq.heapreplace(counts, (count + 1, min_cls))
+
+        if len(Q_index) < n_query:
+            selected = set(Q_index)
+            rest = [idx for idx in range(len(pred)) if idx not in selected]
+            Q_index.extend(random.sample(rest, n_query - len(Q_index)))
+        return Q_index
@@ -0,0 +1,59 @@
+import numpy as np
+
+
+class Pool:
+    """Labeled/unlabeled split of a fixed dataset.
+
+    Membership is a boolean mask over ``data_source``, so labeling a sample is
+    O(1) and the index views are computed with numpy once per change instead
+    of removing indices from a list.
+
+    Args:
+        data_source (list): list of Datum of the whole pool.
+    """
+
+    def __init__(self, data_source):
+        self.data_source = data_source
+        self.labels = np.array([item.label for item in data_source], dtype=np.int64)
+        self.labeled_mask = np.zeros(len(data_source), dtype=bool)
+        self._labeled_order = []  # pool indices in the order they were labeled
+        self._unlabeled_index = None
+
+    def __len__(self):
+        return len(self.data_source)
+
+    @property
+    def num_labeled(self):
+        return len(self._labeled_order)
+
+    @property
+    def unlabeled_index(self):
+        """Ascending pool indices of the unlabeled samples.
+
+        The list is shared by every selector of a round and rebuilt only
+        after the next call to ``label``.
+        """
+        if self._unlabeled_index is None:
+            self._unlabeled_index = np.flatnonzero(~self.labeled_mask).tolist()
+        return self._unlabeled_index
+
+    @property
+    def labeled_index(self):
+        """Pool indices of the labeled samples in labeling order (a copy)."""
+        return list(self._labeled_order)
+
+    def labeled_set(self):
+        return [self.data_source[k] for k in self._labeled_order]
+
+    def label(self, indices):
+        """Move ``indices`` from the unlabeled to the labeled set."""
+        indices = np.asarray(indices, dtype=np.int64)
+        assert len(np.unique(indices)) == len(indices), "duplicate indices"
+        assert not self.labeled_mask[indices].any(), "some samples are already labeled"
+        self.labeled_mask[indices] = True
+        self._labeled_order.extend(indices.tolist())
+        self._unlabeled_index = None
+
+    def class_counts(self, n_class):
+        """Number of labeled samples per class."""
+        return np.bincount(self.labels[self.labeled_mask], minlength=n_class)
@@ -0,0 +1,35 @@
+import torch
+import torch.nn.functional as F
+
+
+MEASURES = ("entropy", "margin", "least_confidence")
+
+
+def uncertainty_scores(logits, measure="entropy"):
+    """Uncertainty of every row of ``logits``, higher is more uncertain.
+
+    Computed on the device of ``logits`` from the log-softmax, so no
+    epsilon is needed inside the log and nothing is copied to the host.
+
+    Args:
+        logits (torch.Tensor): (N, C) class logits.
+        measure (str): "entropy", "margin" (negated gap between the two most
+            probable classes) or "least_confidence" (1 - max probability).
+    """
+    log_probs = F.log_softmax(logits.float(), dim=1)
+    if measure == "entropy":
+        return -(log_probs.exp() * log_probs).sum(1)
+    elif measure == "margin":
+        top2 = log_probs.topk(2, dim=1).values.exp()
+        return top2[:, 1] - top2[:, 0]
+    elif measure == "least_confidence":
+        return 1 - log_probs.max(1).values.exp()
+    else:
+        raise ValueError(f"Unknown uncertainty measure: {measure}")
+
+
+def most_uncertain(scores, k):
+    """Indices of the ``k`` highest ``scores``, most uncertain first, without
+    sorting the whole pool."""
+    k = min(k, scores.shape[0])
+    return torch.topk(scores, k).indices.cpu().numpy()
@@ -2,9 +2,6 @@ from .AL import AL
 import torch
 import numpy as np
 
-from dassl.data.transforms.transforms import build_transform
-from dassl.data.data_manager import build_data_loader
-
 from sklearn.cluster import KMeans
 
 
@@ -15,26 +12,7 @@ class WarmStart(AL):
 
     def get_features(self):
         self.model.eval()
-        unlabeled_features = None
-        with torch.no_grad():
-            unlabeled_loader = build_data_loader(
-                self.cfg,
-                data_source=self.unlabeled_set,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=False),
-                is_train=False,
-            )
-
-            # generate entire unlabeled features set
-            for data in unlabeled_loader:
-                inputs = data["img"].to(self.device)
-                out, features = self.model(inputs, get_feature=True)
-                if unlabeled_features is None:
-                    unlabeled_features = features
-                else:
-                    unlabeled_features = torch.cat((unlabeled_features, features), 0)
+        _, unlabeled_features = self.get_outputs(self.unlabeled_set)
 
         return unlabeled_features
 
@@ -1,8 +1,10 @@
 import os.path as osp
+import random
 from random import sample 
 import time 
 import json 
 
+import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
@@ -10,28 +12,56 @@ from torch.cuda.amp import GradScaler, autocast
 
 from dassl.engine import TRAINER_REGISTRY, TrainerX
 from dassl.metrics import compute_accuracy
-from dassl.utils import load_pretrained_weights, load_checkpoint
+from dassl.utils import load_pretrained_weights, load_checkpoint, mkdir_if_missing
 from dassl.optim import build_optimizer, build_lr_scheduler
 from dassl.data.datasets import build_dataset
 from dassl.data.transforms.transforms import build_transform
 from dassl.data.data_manager import build_data_loader
 
 from clip import clip
-from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
 from .active_learning.pcb import PCB
+from .active_learning.pool import Pool
 from .active_learning.badge import BADGE
 from .active_learning.coreset import Coreset
 from .active_learning.entropy import Entropy
 from .active_learning.warmstart import WarmStart
 from .active_learning.badge_for_filter import BADGE as F_BADGE
 from .active_learning.coreset_for_filter import Coreset as F_Coreset
+from .feature_cache import FeatureCache
+from .infer_loader import InferenceLoader, infer_batch_size, tune_infer_batch_size
+from .aug_bank import AugmentationBank
+from .token_cache import tokenize_prompts
+from .distributed import is_distributed, is_main_process, broadcast_object, broadcast_parameters
 
 import wandb
 import contextlib
 import sys
 import os
 
-_tokenizer = _Tokenizer()
+AL_STATE_FILE = "al_state.pth"  # written after every finished round
+AL_DONE_FILE = "al_done"  # marks a run whose rounds have all finished
+
+
+def get_rng_state():
+    # Plain lists and tensors only, so the state also loads with weights_only
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    state = {
+        "random": random.getstate(),
+        "numpy": (name, keys.tolist(), pos, has_gauss, cached_gaussian),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    name, keys, pos, has_gauss, cached_gaussian = state["numpy"]
+    random.setstate(state["random"])
+    np.random.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss, cached_gaussian))
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
 
 
 
@@ -54,23 +84,40 @@ def load_clip_to_cpu(cfg):
 
 
 class TextEncoder(nn.Module):
-    def __init__(self, clip_model):
+    def __init__(self, clip_model, truncate=False, n_buckets=1):
         super().__init__()
         self.transformer = clip_model.transformer
         self.positional_embedding = clip_model.positional_embedding
         self.ln_final = clip_model.ln_final
         self.text_projection = clip_model.text_projection
         self.dtype = clip_model.dtype
+        self.truncate = truncate
+        self.n_buckets = n_buckets
         
 
     def forward(self, prompts, tokenized_prompts):
-        x = prompts + self.positional_embedding.type(self.dtype)
+        eot = tokenized_prompts.argmax(dim=-1)
+        if not self.truncate:
+            return self.encode(prompts, eot)
+
+        # The attention is causal, so tokens after the EOT never change its
+        # feature: each bucket of prompts only runs up to its longest EOT
+        if self.n_buckets == 1:
+            return self.encode(prompts[:, :int(eot.max()) + 1], eot)
+        order = torch.argsort(eot)
+        x = []
+        for bucket in torch.chunk(order, self.n_buckets):
+            x.append(self.encode(prompts[bucket, :int(eot[bucket].max()) + 1], eot[bucket]))
+        return torch.cat(x)[torch.argsort(order)]
+
+    def encode(self, prompts, eot):
+        x = prompts + self.positional_embedding[:prompts.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
         x = self.transformer(x)
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = self.ln_final(x).type(self.dtype)
 
-        x = x[torch.arange(x.shape[0]), tokenized_prompts.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0]), eot] @ self.text_projection
         return x
 
 
@@ -95,11 +142,11 @@ class PromptLearner(nn.Module):
                 desc_dict = json.load(f)
                 desc_dict = dict((k.lower(), v) for k,v in desc_dict.items())
                 
-            name_lens, prompts = [], []
+            name_texts, prompts = [], []
             for name in classnames:
                 name = name.lower()
                 for desc in desc_dict[name]:
-                    name_lens.append(len(_tokenizer.encode(f"{name}, which is/has {desc}")))
+                    name_texts.append(f"{name}, which is/has {desc}")
                     prompts.append(prompt_prefix + " " + f"{name}, which is/has {desc}.")
                     
         elif cfg.TRAINER.COOPAL.AEPATH:
@@ -107,19 +154,19 @@ class PromptLearner(nn.Module):
                 desc_dict = json.load(f)
                 desc_dict = dict((k.lower(), v) for k,v in desc_dict.items())
                 
-            name_lens, prompts = [], []
+            name_texts, prompts = [], []
             for name in classnames:
                 name = name.lower()
                 for desc in desc_dict[name]:
-                    name_lens.append(len(_tokenizer.encode(f"{name}, which is/has {desc}")))
+                    name_texts.append(f"{name}, which is/has {desc}")
                     prompts.append(prompt_prefix + " " + f"{name}, which is/has {desc}.")
                     
         else:
-            name_lens = [len(_tokenizer.encode(name)) for name in classnames]
+            name_texts = classnames
             prompts = [prompt_prefix + " " + name + "." for name in classnames]
         self.prompts = prompts
         print(prompts[:10])
-        tokenized_prompts = torch.cat([clip.tokenize(p) for p in prompts])
+        tokenized_prompts, name_lens = tokenize_prompts(prompts, name_texts, cfg.TRAINER.COOPAL.TOKEN_CACHE_DIR)
         with torch.no_grad():
             embedding = clip_model.token_embedding(tokenized_prompts).type(dtype)
        
@@ -135,6 +182,8 @@ class PromptLearner(nn.Module):
         self.tokenized_prompts = tokenized_prompts  # torch.Tensor
         self.name_lens = name_lens
         self.class_token_position = cfg.TRAINER.COOP.CLASS_TOKEN_POSITION
+        if self.class_token_position in ("middle", "front"):
+            self.register_buffer("prompt_index", self.build_prompt_index(embedding.size(1)), persistent=False)
        
         if ctx_init:
             # use given words to initialize context vectors
@@ -145,6 +194,7 @@ class PromptLearner(nn.Module):
                 embedding = clip_model.token_embedding(prompt).type(dtype)
             ctx_vectors = embedding[0, 1 : 1 + n_ctx, :]
             prompt_prefix = ctx_init
+            self.ctx_init_vectors = ctx_vectors.clone()
 
         else:
             # random initialization
@@ -155,12 +205,39 @@ class PromptLearner(nn.Module):
                 print("Initializing a generic context")
                 ctx_vectors = torch.empty(n_ctx, ctx_dim, dtype=dtype)
             nn.init.normal_(ctx_vectors, std=0.02)
+            self.ctx_init_vectors = None
 
         print(f'Initial context: "{prompt_prefix}"')
         print(f"Number of context words (tokens): {n_ctx}")
 
         self.ctx = nn.Parameter(ctx_vectors)  # to be optimized
 
+    def reset_parameters(self):
+        """Re-initialize the context vectors as __init__ does."""
+        with torch.no_grad():
+            if self.ctx_init_vectors is not None:
+                self.ctx.copy_(self.ctx_init_vectors)
+            else:
+                ctx_vectors = torch.empty(self.ctx.shape, dtype=self.ctx.dtype)
+                nn.init.normal_(ctx_vectors, std=0.02)
+                self.ctx.copy_(ctx_vectors)
+
+    def build_prompt_index(self, seq_len):
+        """For every class, the position in the "end" layout (prefix, ctx,
+        class tokens, rest of suffix) of each token of the "middle" or "front"
+        layout."""
+        half_n_ctx = self.n_ctx // 2
+        ctx_pos = list(range(1, 1 + self.n_ctx))
+        index = torch.arange(seq_len).repeat(self.n_cls, 1)
+        for i, name_len in enumerate(self.name_lens):
+            class_pos = list(range(1 + self.n_ctx, 1 + self.n_ctx + name_len))
+            if self.class_token_position == "middle":
+                order = [0] + ctx_pos[:half_n_ctx] + class_pos + ctx_pos[half_n_ctx:]
+            else:
+                order = [0] + class_pos + ctx_pos
+            index[i, :len(order)] = torch.tensor(order)
+        return index
+
     def forward(self):
         ctx = self.ctx
         if ctx.dim() == 2:
@@ -169,69 +246,70 @@ class PromptLearner(nn.Module):
         prefix = self.token_prefix
         suffix = self.token_suffix
 
-        if self.class_token_position == "end":
-            prompts = torch.cat(
-                [
-                    prefix,  # (n_cls, 1, dim)
-                    ctx,     # (n_cls, n_ctx, dim)
-                    suffix,  # (n_cls, *, dim)
-                ],
-                dim=1,
-            )
-
-        elif self.class_token_position == "middle":
-            half_n_ctx = self.n_ctx // 2
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i_half1 = ctx[i : i + 1, :half_n_ctx, :]
-                ctx_i_half2 = ctx[i : i + 1, half_n_ctx:, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,     # (1, 1, dim)
-                        ctx_i_half1,  # (1, n_ctx//2, dim)
-                        class_i,      # (1, name_len, dim)
-                        ctx_i_half2,  # (1, n_ctx//2, dim)
-                        suffix_i,     # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        elif self.class_token_position == "front":
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i = ctx[i : i + 1, :, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,  # (1, 1, dim)
-                        class_i,   # (1, name_len, dim)
-                        ctx_i,     # (1, n_ctx, dim)
-                        suffix_i,  # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        else:
+        prompts = torch.cat(
+            [
+                prefix,  # (n_cls, 1, dim)
+                ctx,     # (n_cls, n_ctx, dim)
+                suffix,  # (n_cls, *, dim)
+            ],
+            dim=1,
+        )
+
+        if self.class_token_position in ("middle", "front"):
+            # Reorder the "end" layout into the requested one in a single gather
+            index = self.prompt_index[:, :, None].expand(-1, -1, prompts.shape[-1])
+            prompts = torch.gather(prompts, 1, index)
+
+        elif self.class_token_position != "end":
             raise ValueError
 
         return prompts
     
 
+class DescriptorSegments(nn.Module):
+    """Maps the descriptors of all classes (stored class after class) to
+    their class, so that per-class reductions over descriptors run as one
+    index_add_ / padded softmax instead of a Python loop over classes.
+    """
+    def __init__(self, n_class_desc):
+        super().__init__()
+        n_class_desc = torch.tensor(n_class_desc, dtype=torch.long)
+        self.n_class = len(n_class_desc)
+        max_n = int(n_class_desc.max()) if self.n_class > 0 else 0
+        start = torch.cumsum(n_class_desc, 0) - n_class_desc
+        pad_mask = torch.arange(max_n)[None, :] < n_class_desc[:, None]
+        pad_index = (start[:, None] + torch.arange(max_n)[None, :]).clamp(max=max(int(n_class_desc.sum()) - 1, 0))
+
+        self.register_buffer("desc_label", torch.repeat_interleave(torch.arange(self.n_class), n_class_desc), persistent=False)  # [0, 0, 1, 1, 1, 2, ...]
+        self.register_buffer("desc_count", n_class_desc[self.desc_label], persistent=False)
+        self.register_buffer("pad_index", pad_index, persistent=False)  # (n_class, max_n) descriptor of each slot
+        self.register_buffer("pad_mask", pad_mask, persistent=False)
+
+    def softmax(self, w):
+        """Softmax of the per-descriptor values ``w`` within each class."""
+        padded = w[self.pad_index].masked_fill(~self.pad_mask, float("-inf"))
+        return F.softmax(padded, dim=1)[self.pad_mask]
+
+    def sum(self, x, weight=None, dim=1):
+        """Sum ``x`` over the descriptors of each class along ``dim``, each
+        descriptor scaled by ``weight`` if given."""
+        if weight is not None:
+            shape = [1] * x.dim()
+            shape[dim] = -1
+            x = x * weight.view(shape)
+        out_shape = list(x.shape)
+        out_shape[dim] = self.n_class
+        return x.new_zeros(out_shape).index_add_(dim, self.desc_label, x)
+
+    def mean(self, x, dim=1):
+        return self.sum(x, 1 / self.desc_count.to(x.dtype), dim)
+
+
 class WeightedSumOfLogits(nn.Module):
     def __init__(self, n_class_desc, dtype, weighted_sum_weight=None):
         super().__init__()
         self.n_class_desc = n_class_desc
+        self.segments = DescriptorSegments(n_class_desc)
         
         if weighted_sum_weight is None:
             initial_weighted_sum_weight = []
@@ -241,21 +319,20 @@ class WeightedSumOfLogits(nn.Module):
 
         else:
             self.w = nn.Parameter(weighted_sum_weight)
+
+    def reset_parameters(self, weighted_sum_weight=None):
+        """Reset the weights to uniform, or to ``weighted_sum_weight`` if given."""
+        with torch.no_grad():
+            if weighted_sum_weight is None:
+                self.w.copy_(1 / self.segments.desc_count.to(self.w.dtype))
+            else:
+                self.w.copy_(weighted_sum_weight)
             
+    def softmaxed_weight(self):
+        return self.segments.softmax(self.w)
+
     def forward(self, augmented_logits):
-        weighted_sum_logits = []
-        start = 0
-        for n in self.n_class_desc:
-            same_class_logits = augmented_logits[:, start: start + n]
-            same_class_softmaxed_weight = F.softmax(self.w[start: start + n], dim=0)
-            weighted_sum_logit = same_class_logits @ same_class_softmaxed_weight
-
-            weighted_sum_logits.append(weighted_sum_logit)
-            start += n
-        
-        weighted_sum_logits = torch.stack(weighted_sum_logits, dim=1)
-        
-        return weighted_sum_logits
+        return self.segments.sum(augmented_logits, self.softmaxed_weight())
     
 
 
@@ -266,7 +343,7 @@ class CustomCLIP(nn.Module):
         self.prompt_learner = PromptLearner(cfg, classnames, clip_model)
         self.tokenized_prompts = self.prompt_learner.tokenized_prompts
         self.image_encoder = clip_model.visual
-        self.text_encoder = TextEncoder(clip_model)
+        self.text_encoder = TextEncoder(clip_model, cfg.TRAINER.COOP.TEXT_TRUNCATE, cfg.TRAINER.COOP.TEXT_BUCKETS)
         
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
@@ -288,24 +365,36 @@ class CustomCLIP(nn.Module):
         
             
         
-    def forward(self, image, get_feature=False):
-        image_features = self.image_encoder(image.type(self.dtype))
-        
+    def encode_text(self):
+        """Return the normalized text features of all prompts.
+
+        The result only depends on the prompt parameters, so at inference it
+        can be computed once and passed to ``forward`` for every batch.
+        """
         prompts = self.prompt_learner()
         tokenized_prompts = self.tokenized_prompts
     
         text_features = self.text_encoder(prompts, tokenized_prompts)
         
         if self.cfg.TRAINER.COOPAL.AEPATH:
-            tmp = []
-            start = 0
-            for n in self.n_class_desc:
-                tmp.append(text_features[start:start+n].mean(dim=0))
-                start += n
-            text_features = torch.stack(tmp)
+            text_features = self.weighted_sum.segments.mean(text_features, dim=0)
+
+        return text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def forward(self, image, get_feature=False, text_features=None, from_features=False):
+        # from_features: ``image`` already holds image encoder outputs
+        image_features = image if from_features else self.image_encoder(image.type(self.dtype))
+        return self.forward_features(image_features, get_feature, text_features)
+
+    def forward_with_customized_text_feature(self, image, text_features):
+        return self.forward(image, text_features=text_features)
+
+    def forward_features(self, image_features, get_feature=False, text_features=None):
+        """Classify raw (unnormalized) outputs of the image encoder."""
+        if text_features is None:
+            text_features = self.encode_text()
 
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
 
         logit_scale = self.logit_scale.exp()
         logits = logit_scale * image_features @ text_features.t()
@@ -314,12 +403,7 @@ class CustomCLIP(nn.Module):
             if self.cfg.TRAINER.COOPAL.FILTER: # TODO: filter
                 logits = self.weighted_sum(logits)
             else:
-                tmp = [] 
-                start = 0
-                for n in self.n_class_desc:
-                    tmp.append(torch.sum(logits[:, start:start+n], dim=1)/n)
-                    start += n
-                logits = torch.stack(tmp, dim=1)
+                logits = self.weighted_sum.segments.mean(logits, dim=1)
 
         if get_feature:
             return logits, image_features
@@ -337,6 +421,15 @@ class ALVLM(TrainerX):
     def __init__(self, cfg):
         super().__init__(cfg)
         self.acc = []
+        self.model = None
+        self.feature_cache = None
+        if cfg.TRAINER.COOPAL.FEATURE_CACHE:
+            self.feature_cache = FeatureCache(cfg, cfg.TRAINER.COOPAL.FEATURE_CACHE_DIR)
+        self.aug_bank = None
+        if cfg.TRAINER.COOPAL.AUG_BANK_SIZE > 0:
+            self.aug_bank = AugmentationBank(cfg, cfg.TRAINER.COOPAL.AUG_BANK_SIZE)
+        self.infer_loader = None  # built by setup_inference() once a model exists
+        self.inference_ready = False
         
     def check_cfg(self, cfg):
         assert cfg.TRAINER.COOP.PREC in ["fp16", "fp32", "amp"]
@@ -345,6 +438,27 @@ class ALVLM(TrainerX):
         cfg = self.cfg
         classnames = self.dm.dataset.classnames
 
+        if self.model is not None:
+            # The CLIP backbone is frozen, so from the second build on only the
+            # learnable parts are re-initialized instead of reloading CLIP.
+            # This skips the random draws of CLIP's own initialization, so the
+            # torch random stream of later rounds (context init, loader
+            # shuffling) differs from rebuilding the model every round
+            print("Resetting the prompt learner and the filter weights")
+            model = self.get_inference_model()
+            model.prompt_learner.reset_parameters()
+            if not cfg.TRAINER.COOPAL.ASPATH:
+                weighted_sum_weight = None
+            model.weighted_sum.reset_parameters(weighted_sum_weight)
+            model.weighted_sum_weight = weighted_sum_weight
+            if cfg.MODEL.INIT_WEIGHTS:
+                load_pretrained_weights(model.prompt_learner, cfg.MODEL.INIT_WEIGHTS)
+            # DDP only syncs parameters when it wraps the model
+            broadcast_parameters(model.prompt_learner)
+            broadcast_parameters(model.weighted_sum)
+            self.build_optimizers(model)
+            return
+
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
         clip_model = load_clip_to_cpu(cfg)
         
@@ -370,17 +484,14 @@ class ALVLM(TrainerX):
             load_pretrained_weights(self.model.prompt_learner, cfg.MODEL.INIT_WEIGHTS)
 
         self.model.to(self.device)
-        
-        self.optim = build_optimizer(self.model.prompt_learner, cfg.OPTIM)
-        self.sched = build_lr_scheduler(self.optim, cfg.OPTIM)
-        self.register_model(f"prompt_learner", self.model.prompt_learner, self.optim, self.sched)
+        self.build_optimizers(self.model)
 
-        filter_optim_cfg = get_filter_optim_cfg(cfg)
-        self.filter_optim = build_optimizer(self.model.weighted_sum, filter_optim_cfg)
-        self.filter_sched = build_lr_scheduler(self.filter_optim, filter_optim_cfg)
-        self.register_model("weighted_sum", self.model.weighted_sum, self.filter_optim, self.filter_sched)
-
-        self.scaler = GradScaler() if cfg.TRAINER.COOP.PREC == "amp" else None
+        if is_distributed():
+            # One process per device, only the prompt gradients are all-reduced.
+            # The filter weights are unused without FILTER.
+            device_ids = [self.device.index or torch.cuda.current_device()] if self.device.type == "cuda" else None
+            self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=device_ids, find_unused_parameters=True)
+            return
 
         # Note that multi-gpu training could be slow because CLIP's size is
         # big, which slows down the copy operation in DataParallel
@@ -390,20 +501,35 @@ class ALVLM(TrainerX):
             self.model = nn.DataParallel(self.model)
             #print(self.model)
 
+    def build_optimizers(self, model):
+        cfg = self.cfg
+        self.optim = build_optimizer(model.prompt_learner, cfg.OPTIM)
+        self.sched = build_lr_scheduler(self.optim, cfg.OPTIM)
+        self.register_model(f"prompt_learner", model.prompt_learner, self.optim, self.sched)
+
+        filter_optim_cfg = get_filter_optim_cfg(cfg)
+        self.filter_optim = build_optimizer(model.weighted_sum, filter_optim_cfg)
+        self.filter_sched = build_lr_scheduler(self.filter_optim, filter_optim_cfg)
+        self.register_model("weighted_sum", model.weighted_sum, self.filter_optim, self.filter_sched)
+
+        self.scaler = GradScaler() if cfg.TRAINER.COOP.PREC == "amp" else None
+
     def forward_backward(self, batch):
         image, label = self.parse_batch_train(batch)
+        # Batches from the augmentation bank hold image features, not images
+        from_features = "feat" in batch
         
         prec = self.cfg.TRAINER.COOP.PREC
         if prec == "amp":
             with autocast():
-                output = self.model(image)
+                output = self.model(image, from_features=from_features)
                 loss = F.cross_entropy(output, label)
             self.optim.zero_grad()
             self.scaler.scale(loss).backward()
             self.scaler.step(self.optim)
             self.scaler.update()
         else:
-            output = self.model(image)
+            output = self.model(image, from_features=from_features)
             loss = F.cross_entropy(output, label)
             self.model_backward_and_update(loss)
 
@@ -418,7 +544,7 @@ class ALVLM(TrainerX):
         return loss_summary
 
     def parse_batch_train(self, batch):
-        input = batch["img"]
+        input = batch["feat"] if "feat" in batch else batch["img"]
         label = batch["label"]
         input = input.to(self.device)
         label = label.to(self.device)
@@ -458,10 +584,84 @@ class ALVLM(TrainerX):
             # set strict=False
             self._models[name].load_state_dict(state_dict, strict=False)
     
+    @torch.no_grad()
+    def test(self, split=None):
+        """Evaluate from cached image features when the feature cache is on.
+
+        The image encoder is frozen and the test transform is deterministic,
+        so the split is encoded once and every later evaluation is a matmul
+        against the current text features.
+        """
+        if self.feature_cache is None:
+            return super().test(split)
+
+        self.set_model_mode("eval")
+        self.evaluator.reset()
+
+        if split is None:
+            split = self.cfg.TEST.SPLIT
+
+        if split == "val" and self.dm.dataset.val:
+            data_source = self.dm.dataset.val
+        else:
+            split = "test"  # in case there is no val set
+            data_source = self.dm.dataset.test
+
+        print(f"Evaluate on the *{split}* set (cached features)")
+
+        model = self.get_inference_model()
+        text_features = model.encode_text()
+        image_features = self.feature_cache.get(model, data_source, self.device)
+        labels = torch.tensor([item.label for item in data_source], device=self.device)
+        batch_size = self.cfg.DATALOADER.TEST.BATCH_SIZE
+        for start in range(0, len(data_source), batch_size):
+            output = model.forward_features(image_features[start:start + batch_size], text_features=text_features)
+            self.evaluator.process(output, labels[start:start + batch_size])
+
+        results = self.evaluator.evaluate()
+
+        for k, v in results.items():
+            tag = f"{split}/{k}"
+            self.write_scalar(tag, v, self.epoch)
+
+        return list(results.values())[0]
+
+    def save_al_state(self, state):
+        """Atomically write the active-learning state reached after a round."""
+        if not is_main_process():
+            return
+        mkdir_if_missing(self.output_dir)
+        path = osp.join(self.output_dir, AL_STATE_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save(state, tmp_path)
+        os.replace(tmp_path, path)
+
+    def load_al_state(self, directory):
+        path = osp.join(directory, AL_STATE_FILE)
+        if not osp.exists(path):
+            print(f"No active learning state at {path}, start from the first round")
+            return None
+        state = torch.load(path, map_location="cpu")
+        print(f"Resume from {path} after round {state['round']}")
+        return state
+
     def before_train(self, weighted_sum_weight=None):
         print("INITIALIZE the prompts weights")
         self.build_model(weighted_sum_weight)
         
+    def setup_inference(self, data_source):
+        """Tune the inference batch size and build the shared inference
+        loader over ``data_source``, once per run. Needs the model, so it is
+        called after the first ``before_train``."""
+        if self.inference_ready:
+            return
+        self.inference_ready = True
+        if self.cfg.DATALOADER.INFER.AUTO_TUNE:
+            tune_infer_batch_size(self.cfg, self.get_inference_model(), self.device)
+        if self.cfg.TRAINER.COOPAL.SHARED_INFER_LOADER:
+            # One set of data-loader workers serves every scoring pass of the run
+            self.infer_loader = InferenceLoader(self.cfg, data_source, infer_batch_size(self.cfg))
+
     def after_train(self):
         print("Finish training")
         do_test = not self.cfg.TEST.NO_TEST
@@ -485,7 +685,7 @@ class ALVLM(TrainerX):
             MODE = "AS"
         else:
             MODE = "none"
-        if self.cfg.WANDB_PROJECT_NAME:
+        if self.cfg.WANDB_PROJECT_NAME and is_main_process():
             os.environ["WANDB__SERVICE_WAIT"] = "300"
             wandb.init(
                 project = self.cfg.WANDB_PROJECT_NAME,
@@ -515,7 +715,7 @@ class ALVLM(TrainerX):
         
         print(f"dataset length: {len(dataset.train_x)}")
         unlabeled_dst = dataset.train_x 
-        U_index = list(range(len(unlabeled_dst)))
+        pool = Pool(unlabeled_dst)
         if self.cfg.TRAINER.COOP.CSC:
             n_query = dataset.get_num_classes(unlabeled_dst)
         else:
@@ -524,36 +724,58 @@ class ALVLM(TrainerX):
         
         dataset._train_x = []
         weighted_sum_weight = None
-        for i in range(TARGET_ROUND):
+        queried_index = []
+        start_round = 0
+        state = self.load_al_state(self.cfg.RESUME) if self.cfg.RESUME else None
+        if state is not None:
+            start_round = state["round"]
+            queried_index = state["queried_index"]
+            self.acc = state["acc"]
+            weighted_sum_weight = state["weighted_sum_weight"]
+            pool.label(state["labeled_index"])
+            dataset._train_x = pool.labeled_set()
+            if start_round < TARGET_ROUND:
+                # The next selection scores the pool with the last trained model
+                self.before_train(weighted_sum_weight)
+                self.setup_inference(unlabeled_dst)
+                model = self.get_inference_model()
+                model.prompt_learner.load_state_dict(state["model"]["prompt_learner"])
+                model.weighted_sum.load_state_dict(state["model"]["weighted_sum"])
+            set_rng_state(state["rng"])
+
+        for i in range(start_round, TARGET_ROUND):
             start = time.time()
+            selector = None
+            U_index = pool.unlabeled_index
             if self.cfg.TRAINER.COOPAL.METHOD == "random" or (self.cfg.TRAINER.COOPAL.WARM_START == False) and i == 0:
                 idx = sample(U_index, n_query)
                 
             elif self.cfg.TRAINER.COOPAL.WARM_START == True and i == 0:
                 self.before_train()
+                self.setup_inference(unlabeled_dst)
                 print("\n\n Warm Start \n\n")
-                selector = WarmStart(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device)
+                selector = WarmStart(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device, feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 idx = selector.select(n_query)
 
             elif self.cfg.TRAINER.COOPAL.METHOD == "entropy":
-                selector = Entropy(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device)
+                selector = Entropy(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device, feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 idx = selector.select(n_cand)
 
             elif self.cfg.TRAINER.COOPAL.METHOD == "badge":
                 if self.cfg.TRAINER.COOPAL.ALMETHOD_FOR_FILTER:
                     print("\n\n BADGE FOR FILTER \n\n")
-                    selector = F_BADGE(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device)
+                    selector = F_BADGE(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device, feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 else:
-                    selector = BADGE(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device)
+                    selector = BADGE(self.cfg, self.model, unlabeled_dst, U_index, dataset.get_num_classes(unlabeled_dst), self.device, feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 idx = selector.select(n_cand)
 
             elif self.cfg.TRAINER.COOPAL.METHOD == "coreset":
                 val_x = dataset._train_x.copy()
                 if self.cfg.TRAINER.COOPAL.ALMETHOD_FOR_FILTER:
                     print("\n\n CORESET FOR FILTER \n\n")
-                    selector = F_Coreset(self.cfg, self.model, unlabeled_dst, U_index, val_x, dataset.get_num_classes(unlabeled_dst))
+                    selector = F_Coreset(self.cfg, self.model, unlabeled_dst, U_index, val_x, dataset.get_num_classes(unlabeled_dst), feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 else:
-                    selector = Coreset(self.cfg, self.model, unlabeled_dst, U_index, val_x, dataset.get_num_classes(unlabeled_dst))
+                    selector = Coreset(self.cfg, self.model, unlabeled_dst, U_index, val_x, dataset.get_num_classes(unlabeled_dst), feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 idx = selector.select(n_cand)
 
             else:
@@ -561,40 +783,48 @@ class ALVLM(TrainerX):
                 idx = U_index
             
             if i != 0:
-                statistics = torch.zeros(self.num_classes)
-                for elem in dataset._train_x:
-                    statistics[elem.label] += 1
-                selector = PCB(self.cfg, self.model, unlabeled_dst, idx, dataset.get_num_classes(unlabeled_dst), statistics, self.device)
+                statistics = torch.from_numpy(pool.class_counts(self.num_classes)).float()
+                # Reuse the predictions the selector already made for the candidates
+                pred = selector.get_predictions(idx) if selector is not None else None
+                selector = PCB(self.cfg, self.model, unlabeled_dst, idx, dataset.get_num_classes(unlabeled_dst), statistics, self.device, pred=pred, feature_cache=self.feature_cache, infer_loader=self.infer_loader)
                 idx = selector.select(n_query)
             
-            for k in idx:
-                dataset._train_x.append(unlabeled_dst[k])
-                U_index.remove(k)
-            assert len(U_index) + len(dataset.train_x) == len(unlabeled_dst), f"u index: {len(U_index)}\t train set: {len(dataset.train_x)}\t unlabeled_dst: {len(unlabeled_dst)}"
+            # Every rank selects the same way, but rank 0 decides
+            idx = broadcast_object(list(idx))
+            pool.label(idx)
+            dataset._train_x.extend(unlabeled_dst[k] for k in idx)
+            queried_index.append(list(idx))
+            assert pool.num_labeled == len(dataset.train_x), f"labeled: {pool.num_labeled}\t train set: {len(dataset.train_x)}"
             
-            self.train_loader_x = build_data_loader(
-                self.cfg,
-                sampler_type=self.cfg.DATALOADER.TRAIN_X.SAMPLER,
-                data_source=dataset.train_x,
-                batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
-                n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
-                n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
-                tfm=build_transform(self.cfg, is_train=True),
-                is_train=True,
-                dataset_wrapper=None
-            )   
+            if self.aug_bank is None:
+                self.train_loader_x = build_data_loader(
+                    self.cfg,
+                    sampler_type="DistributedSampler" if is_distributed() else self.cfg.DATALOADER.TRAIN_X.SAMPLER,
+                    data_source=dataset.train_x,
+                    batch_size=self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
+                    n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
+                    n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
+                    tfm=build_transform(self.cfg, is_train=True),
+                    is_train=True,
+                    dataset_wrapper=None
+                )   
 
             self.before_train(weighted_sum_weight) # build model
+            self.setup_inference(unlabeled_dst)
+
+            if self.aug_bank is not None:
+                # Needs the image encoder, so only after the model is built
+                self.aug_bank.update(self.get_inference_model(), dataset.train_x, self.device)
+                self.train_loader_x = self.aug_bank.build_loader(dataset.train_x)
 
             print("\n\n=== Start training ===")
-            if torch.cuda.device_count() > 1:
-                model_for_eval = self.model.module
-            else:
-                model_for_eval = self.model
+            model_for_eval = self.get_inference_model()
 
             print_filter(model_for_eval)
             for self.epoch in range(self.start_epoch, self.max_epoch):
                 self.before_epoch()
+                if hasattr(self.train_loader_x.sampler, "set_epoch"):
+                    self.train_loader_x.sampler.set_epoch(self.epoch)
                 self.run_epoch()
                 self.after_epoch()
             self.after_train()
@@ -605,9 +835,25 @@ class ALVLM(TrainerX):
 
             print("\nTraining time for {}-th round: {:.2f} seconds".format(i, time.time() - start))
 
-            if self.cfg.WANDB_PROJECT_NAME:
+            if self.cfg.WANDB_PROJECT_NAME and is_main_process():
                 wandb.log({"acc": self.acc[-1], "round": i+1, "total_budget": n_query*(i+1), "round_budget": n_query}, step=n_query*(i+1))
 
+            self.save_al_state({
+                "round": i + 1,
+                "labeled_index": pool.labeled_index,
+                "queried_index": queried_index,
+                "weighted_sum_weight": weighted_sum_weight.cpu(),
+                "model": {
+                    "prompt_learner": model_for_eval.prompt_learner.state_dict(),
+                    "weighted_sum": model_for_eval.weighted_sum.state_dict(),
+                },
+                "acc": self.acc,
+                "rng": get_rng_state(),
+            })
+
+        if is_main_process():
+            open(osp.join(self.output_dir, AL_DONE_FILE), "w").close()
+
         print("=== Result Overview ===")
         for i in range(len(self.acc)):
             print(f"{i}: {self.acc[i]}")
@@ -637,14 +883,7 @@ def print_filter(model,num_of_displayed_class=10):
     n_class_desc = model.n_class_desc
     prompts = model.prompt_learner.prompts
     weighted_sum_weight = model.weighted_sum.w.detach()
-
-    start = 0
-    softmaxed_weight = []
-    start = 0
-    for n in n_class_desc:
-        same_class_softmaxed_weight = torch.nn.functional.softmax(weighted_sum_weight[start: start + n], dim=0)
-        softmaxed_weight.extend(same_class_softmaxed_weight)
-        start += n
+    softmaxed_weight = model.weighted_sum.softmaxed_weight().detach()
     
     print("\n\n <Filtered descriptions>")
     print("[weight]\t[softmaxed weight] * [description]")
@@ -0,0 +1,103 @@
+import torch
+from torch.utils.data import Dataset as TorchDataset
+from tqdm import tqdm
+
+from dassl.data.transforms.transforms import build_transform
+from dassl.data.data_manager import build_data_loader
+from dassl.data.samplers import build_sampler
+
+from .distributed import is_distributed
+from .infer_loader import infer_batch_size
+
+
+class AugmentationBank:
+    """Frozen CLIP features of ``n_views`` augmented views of every labeled image.
+
+    Only the prompt context and the filter weights are trained, so the image
+    encoder output of an augmented view never changes. Each labeled image is
+    encoded ``n_views`` times with the train transform when it enters the
+    labeled set, and every epoch draws one of its views instead of decoding,
+    augmenting and encoding the image again.
+    """
+
+    def __init__(self, cfg, n_views):
+        self.cfg = cfg
+        self.n_views = n_views
+        self.tfm = build_transform(cfg, is_train=True)
+        self.index = {}  # impath -> row of self.features
+        self.features = None  # (n_images, n_views, dim), kept on the CPU
+
+    def __len__(self):
+        return len(self.index)
+
+    @torch.no_grad()
+    def update(self, model, data_source, device):
+        """Encode the views of the images of ``data_source`` that are not in the bank yet."""
+        missing = []
+        seen = set()
+        for item in data_source:
+            if item.impath not in self.index and item.impath not in seen:
+                missing.append(item)
+                seen.add(item.impath)
+        if not missing:
+            return
+
+        print(f"Encoding {self.n_views} augmented views of {len(missing)} images")
+        loader = build_data_loader(
+            self.cfg,
+            data_source=missing,
+            batch_size=infer_batch_size(self.cfg),
+            tfm=self.tfm,
+            is_train=False,
+        )
+        views = []
+        for _ in range(self.n_views):
+            features = []
+            for batch in tqdm(loader):
+                image = batch["img"].to(device)
+                features.append(model.image_encoder(image.type(model.dtype)).cpu())
+            views.append(torch.cat(features))
+        features = torch.stack(views, dim=1)
+
+        start = 0 if self.features is None else len(self.features)
+        self.features = features if self.features is None else torch.cat([self.features, features])
+        for i, item in enumerate(missing):
+            self.index[item.impath] = start + i
+
+    def build_loader(self, data_source):
+        """Training loader over ``data_source`` yielding {"feat", "label", "index"} batches."""
+        batch_size = self.cfg.DATALOADER.TRAIN_X.BATCH_SIZE
+        sampler = build_sampler(
+            "DistributedSampler" if is_distributed() else self.cfg.DATALOADER.TRAIN_X.SAMPLER,
+            cfg=self.cfg,
+            data_source=data_source,
+            batch_size=batch_size,
+            n_domain=self.cfg.DATALOADER.TRAIN_X.N_DOMAIN,
+            n_ins=self.cfg.DATALOADER.TRAIN_X.N_INS,
+        )
+        return torch.utils.data.DataLoader(
+            AugmentationBankDataset(self, data_source),
+            batch_size=batch_size,
+            sampler=sampler,
+            drop_last=len(data_source) >= batch_size,
+        )
+
+
+class AugmentationBankDataset(TorchDataset):
+    """Draws one random view from the bank per sample and access."""
+
+    def __init__(self, bank, data_source):
+        self.bank = bank
+        self.data_source = data_source
+        self.rows = [bank.index[item.impath] for item in data_source]
+
+    def __len__(self):
+        return len(self.data_source)
+
+    def __getitem__(self, idx):
+        view = torch.randint(self.bank.n_views, ()).item()
+        return {
+            "feat": self.bank.features[self.rows[idx], view],
+            "label": self.data_source[idx].label,
+            "index": idx,
+        }
@@ -11,9 +11,7 @@ from dassl.utils import load_pretrained_weights, load_checkpoint
 from dassl.optim import build_optimizer, build_lr_scheduler
 
 from clip import clip
-from clip.simple_tokenizer import SimpleTokenizer as _Tokenizer
-
-_tokenizer = _Tokenizer()
+from .token_cache import tokenize_prompts
 
 
 def load_clip_to_cpu(cfg):
@@ -35,24 +33,41 @@ def load_clip_to_cpu(cfg):
 
 
 class TextEncoder(nn.Module):
-    def __init__(self, clip_model):
+    def __init__(self, clip_model, truncate=False, n_buckets=1):
         super().__init__()
         self.transformer = clip_model.transformer
         self.positional_embedding = clip_model.positional_embedding
         self.ln_final = clip_model.ln_final
         self.text_projection = clip_model.text_projection
         self.dtype = clip_model.dtype
+        self.truncate = truncate
+        self.n_buckets = n_buckets
 
     def forward(self, prompts, tokenized_prompts):
-        x = prompts + self.positional_embedding.type(self.dtype)
+        # take features from the eot embedding (eot_token is the highest number in each sequence)
+        eot = tokenized_prompts.argmax(dim=-1)
+        if not self.truncate:
+            return self.encode(prompts, eot)
+
+        # The attention is causal, so tokens after the EOT never change its
+        # feature: each bucket of prompts only runs up to its longest EOT
+        if self.n_buckets == 1:
+            return self.encode(prompts[:, :int(eot.max()) + 1], eot)
+        order = torch.argsort(eot)
+        x = []
+        for bucket in torch.chunk(order, self.n_buckets):
+            x.append(self.encode(prompts[bucket, :int(eot[bucket].max()) + 1], eot[bucket]))
+        return torch.cat(x)[torch.argsort(order)]
+
+    def encode(self, prompts, eot):
+        x = prompts + self.positional_embedding[:prompts.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
         x = self.transformer(x)
         x = x.permute(1, 0, 2)  # LND -> NLD
         x = self.ln_final(x).type(self.dtype)
 
         # x.shape = [batch_size, n_ctx, transformer.width]
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), tokenized_prompts.argmax(dim=-1)] @ self.text_projection
+        x = x[torch.arange(x.shape[0]), eot] @ self.text_projection
 
         return x
 
@@ -96,10 +111,9 @@ class PromptLearner(nn.Module):
         self.ctx = nn.Parameter(ctx_vectors)  # to be optimized
 
         classnames = [name.replace("_", " ") for name in classnames]
-        name_lens = [len(_tokenizer.encode(name)) for name in classnames]
         prompts = [prompt_prefix + " " + name + "." for name in classnames]
 
-        tokenized_prompts = torch.cat([clip.tokenize(p) for p in prompts])
+        tokenized_prompts, name_lens = tokenize_prompts(prompts, classnames)
         with torch.no_grad():
             embedding = clip_model.token_embedding(tokenized_prompts).type(dtype)
 
@@ -114,6 +128,24 @@ class PromptLearner(nn.Module):
         self.tokenized_prompts = tokenized_prompts  # torch.Tensor
         self.name_lens = name_lens
         self.class_token_position = cfg.TRAINER.COOP.CLASS_TOKEN_POSITION
+        if self.class_token_position in ("middle", "front"):
+            self.register_buffer("prompt_index", self.build_prompt_index(embedding.size(1)), persistent=False)
+
+    def build_prompt_index(self, seq_len):
+        """For every class, the position in the "end" layout (prefix, ctx,
+        class tokens, rest of suffix) of each token of the "middle" or "front"
+        layout."""
+        half_n_ctx = self.n_ctx // 2
+        ctx_pos = list(range(1, 1 + self.n_ctx))
+        index = torch.arange(seq_len).repeat(self.n_cls, 1)
+        for i, name_len in enumerate(self.name_lens):
+            class_pos = list(range(1 + self.n_ctx, 1 + self.n_ctx + name_len))
+            if self.class_token_position == "middle":
+                order = [0] + ctx_pos[:half_n_ctx] + class_pos + ctx_pos[half_n_ctx:]
+            else:
+                order = [0] + class_pos + ctx_pos
+            index[i, :len(order)] = torch.tensor(order)
+        return index
 
     def forward(self):
         ctx = self.ctx
@@ -123,60 +155,21 @@ class PromptLearner(nn.Module):
         prefix = self.token_prefix
         suffix = self.token_suffix
 
-        if self.class_token_position == "end":
-            prompts = torch.cat(
-                [
-                    prefix,  # (n_cls, 1, dim)
-                    ctx,     # (n_cls, n_ctx, dim)
-                    suffix,  # (n_cls, *, dim)
-                ],
-                dim=1,
-            )
-
-        elif self.class_token_position == "middle":
-            half_n_ctx = self.n_ctx // 2
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i_half1 = ctx[i : i + 1, :half_n_ctx, :]
-                ctx_i_half2 = ctx[i : i + 1, half_n_ctx:, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,     # (1, 1, dim)
-                        ctx_i_half1,  # (1, n_ctx//2, dim)
-                        class_i,      # (1, name_len, dim)
-                        ctx_i_half2,  # (1, n_ctx//2, dim)
-                        suffix_i,     # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        elif self.class_token_position == "front":
-            prompts = []
-            for i in range(self.n_cls):
-                name_len = self.name_lens[i]
-                prefix_i = prefix[i : i + 1, :, :]
-                class_i = suffix[i : i + 1, :name_len, :]
-                suffix_i = suffix[i : i + 1, name_len:, :]
-                ctx_i = ctx[i : i + 1, :, :]
-                prompt = torch.cat(
-                    [
-                        prefix_i,  # (1, 1, dim)
-                        class_i,   # (1, name_len, dim)
-                        ctx_i,     # (1, n_ctx, dim)
-                        suffix_i,  # (1, *, dim)
-                    ],
-                    dim=1,
-                )
-                prompts.append(prompt)
-            prompts = torch.cat(prompts, dim=0)
-
-        else:
+        prompts = torch.cat(
+            [
+                prefix,  # (n_cls, 1, dim)
+                ctx,     # (n_cls, n_ctx, dim)
+                suffix,  # (n_cls, *, dim)
+            ],
+            dim=1,
+        )
+
+        if self.class_token_position in ("middle", "front"):
+            # Reorder the "end" layout into the requested one in a single gather
+            index = self.prompt_index[:, :, None].expand(-1, -1, prompts.shape[-1])
+            prompts = torch.gather(prompts, 1, index)
+
+        elif self.class_token_position != "end":
             raise ValueError
 
         return prompts
@@ -188,25 +181,33 @@ class CustomCLIP(nn.Module):
         self.prompt_learner = PromptLearner(cfg, classnames, clip_model)
         self.tokenized_prompts = self.prompt_learner.tokenized_prompts
         self.image_encoder = clip_model.visual
-        self.text_encoder = TextEncoder(clip_model)
+        self.text_encoder = TextEncoder(clip_model, cfg.TRAINER.COOP.TEXT_TRUNCATE, cfg.TRAINER.COOP.TEXT_BUCKETS)
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
 
-    def forward(self, image):
-        image_features = self.image_encoder(image.type(self.dtype))
-
+    def encode_text(self):
+        """Return the normalized text features of all class prompts."""
         prompts = self.prompt_learner()
         tokenized_prompts = self.tokenized_prompts
         text_features = self.text_encoder(prompts, tokenized_prompts)
+        return text_features / text_features.norm(dim=-1, keepdim=True)
+
+    def forward(self, image, text_features=None):
+        image_features = self.image_encoder(image.type(self.dtype))
+
+        if text_features is None:
+            text_features = self.encode_text()
 
         image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
 
         logit_scale = self.logit_scale.exp()
         logits = logit_scale * image_features @ text_features.t()
 
         return logits
 
+    def forward_with_customized_text_feature(self, image, text_features):
+        return self.forward(image, text_features=text_features)
+
 
 @TRAINER_REGISTRY.register()
 class CoOp(TrainerX):
@@ -0,0 +1,91 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+def init_distributed():
+    """Join the process group set up by torchrun (WORLD_SIZE > 1).
+
+    Uses NCCL with one GPU per process when CUDA is available, gloo on the
+    CPU otherwise. Returns True if running distributed.
+    """
+    if int(os.environ.get("WORLD_SIZE", 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        if torch.cuda.is_available():
+            torch.cuda.set_device(int(os.environ.get("LOCAL_RANK", 0)))
+        dist.init_process_group(backend="nccl" if torch.cuda.is_available() else "gloo")
+    return True
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def shard_range(n):
+    """Contiguous [start, end) part of ``n`` items handled by this rank."""
+    rank, world_size = get_rank(), get_world_size()
+    return n * rank // world_size, n * (rank + 1) // world_size
+
+
+def all_gather_rows(tensor):
+    """Concatenate the row shards of all ranks, in rank order.
+
+    Shards may differ in length by one row (see ``shard_range``), so they are
+    padded to the longest before the all_gather.
+    """
+    if not is_distributed():
+        return tensor
+    n = torch.tensor([tensor.shape[0]], device=tensor.device)
+    sizes = [torch.zeros_like(n) for _ in range(get_world_size())]
+    dist.all_gather(sizes, n)
+    sizes = [int(size) for size in sizes]
+    padded = tensor.new_zeros((max(sizes),) + tuple(tensor.shape[1:]))
+    padded[:tensor.shape[0]] = tensor
+    gathered = [torch.zeros_like(padded) for _ in sizes]
+    dist.all_gather(gathered, padded)
+    return torch.cat([shard[:size] for shard, size in zip(gathered, sizes)])
+
+
+def all_gather_object(obj):
+    """Return the list of ``obj`` of all ranks, in rank order."""
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """Return ``obj`` of rank ``src`` on every rank."""
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def broadcast_parameters(module, src=0):
+    """Copy the parameters of ``module`` on rank ``src`` to every rank."""
+    if not is_distributed():
+        return
+    for param in module.parameters():
+        dist.broadcast(param.data, src=src)
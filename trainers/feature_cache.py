@@ -0,0 +1,140 @@
+import os
+import hashlib
+import os.path as osp
+
+import torch
+from tqdm import tqdm
+
+from dassl.data.transforms.transforms import build_transform
+from dassl.data.data_manager import build_data_loader
+from dassl.data.image_store import get_image_store
+from dassl.utils import mkdir_if_missing
+
+from .distributed import is_main_process, all_gather_object, barrier
+from .infer_loader import infer_batch_size
+
+
+class FeatureCache:
+    """Store of frozen CLIP image features keyed by image path.
+
+    The image encoder never receives gradients, so its output only depends on
+    (backbone, image path, eval transform, image store). Features are computed once and
+    reused by every selector in every round. If ``cache_dir`` is given, the
+    store is also written to disk so that runs with other seeds on the same
+    backbone can share it.
+    """
+
+    def __init__(self, cfg, cache_dir=""):
+        self.cfg = cfg
+        self.tfm = build_transform(cfg, is_train=False)
+        key = [cfg.MODEL.BACKBONE.NAME, cfg.TRAINER.COOP.PREC, repr(self.tfm)]
+        if cfg.DATALOADER.IMAGE_STORE:
+            # Stored images were resized once already and encode differently
+            store = get_image_store(cfg.DATALOADER.IMAGE_STORE)
+            key += [osp.abspath(store.root), f"short_side={store.short_side}"]
+        key = "|".join(key)
+        self.key = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+
+        self.path = None
+        if cache_dir:
+            mkdir_if_missing(cache_dir)
+            backbone = cfg.MODEL.BACKBONE.NAME.replace("/", "-")
+            self.path = osp.join(cache_dir, f"{backbone}_{self.key}.pth")
+
+        self.index = {}  # impath -> row of self.features
+        self.features = None
+        self.load()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, impath):
+        return impath in self.index
+
+    def load(self):
+        if self.path is None or not osp.exists(self.path):
+            return
+        data = torch.load(self.path, map_location="cpu")
+        self._add(data["impaths"], data["features"])
+        print(f"Loaded {len(self.index)} cached image features from {self.path}")
+
+    def save(self):
+        """Write the store to disk. Collective when distributed: only the
+        main process writes, the other ranks wait for it at a barrier."""
+        if self.path is None:
+            return
+        if is_main_process():
+            self._write()
+        barrier()
+
+    def _write(self):
+        # Merge with whatever other runs have written in the meantime
+        if osp.exists(self.path):
+            data = torch.load(self.path, map_location="cpu")
+            self._add(data["impaths"], data["features"])
+        impaths = [None] * len(self.index)
+        for impath, row in self.index.items():
+            impaths[row] = impath
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        torch.save({"impaths": impaths, "features": self.features}, tmp_path)
+        os.replace(tmp_path, self.path)
+
+    def _add(self, impaths, features):
+        new_rows = [i for i, impath in enumerate(impaths) if impath not in self.index]
+        if not new_rows:
+            return
+        features = features[new_rows].cpu()
+        start = len(self.index)
+        for i, row in enumerate(new_rows):
+            self.index[impaths[row]] = start + i
+        if self.features is None:
+            self.features = features
+        else:
+            self.features = torch.cat([self.features, features.to(self.features.dtype)])
+
+    @torch.no_grad()
+    def encode(self, model, data_source, device, infer_loader=None):
+        """Run the image encoder over ``data_source`` and return its raw output."""
+        loader = infer_loader.loader_for(data_source) if infer_loader is not None else None
+        if loader is None:
+            loader = build_data_loader(
+                self.cfg,
+                data_source=data_source,
+                batch_size=infer_batch_size(self.cfg),
+                tfm=self.tfm,
+                is_train=False,
+            )
+        features = []
+        for batch in tqdm(loader):
+            image = batch["img"].to(device)
+            features.append(model.image_encoder(image.type(model.dtype)).cpu())
+        return torch.cat(features)
+
+    def get(self, model, data_source, device, infer_loader=None):
+        """Return raw image features for ``data_source`` (in order) on ``device``.
+
+        Images that are not in the store yet are encoded with ``model`` and
+        added to it, through ``infer_loader`` if they belong to its pool.
+        """
+        impaths = [item.impath for item in data_source]
+        missing = []
+        seen = set()
+        for item in data_source:
+            if item.impath not in self.index and item.impath not in seen:
+                missing.append(item)
+                seen.add(item.impath)
+
+        new = ([], None)
+        if missing:
+            print(f"Encoding {len(missing)} images that are not in the feature cache")
+            new = ([item.impath for item in missing], self.encode(model, missing, device, infer_loader))
+        # Ranks encode different shards when distributed, every rank keeps all of them
+        new_by_rank = all_gather_object(new)
+        if any(features is not None for _, features in new_by_rank):
+            for new_impaths, features in new_by_rank:
+                if features is not None:
+                    self._add(new_impaths, features)
+            self.save()
+
+        rows = torch.tensor([self.index[impath] for impath in impaths], dtype=torch.long)
+        return self.features[rows].to(device)
@@ -0,0 +1,152 @@
+import os
+import json
+import os.path as osp
+import torch
+from torch.utils.data import Sampler
+
+from dassl.data.transforms.transforms import build_transform
+from dassl.data.data_manager import build_data_loader
+from dassl.utils import mkdir_if_missing
+
+
+def infer_batch_size(cfg):
+    """Batch size of no-grad scoring passes."""
+    return cfg.DATALOADER.INFER.BATCH_SIZE or cfg.DATALOADER.TRAIN_X.BATCH_SIZE
+
+
+@torch.no_grad()
+def probe_batch_size(model, cfg, device, max_batch_size):
+    """Largest batch size, halving from ``max_batch_size``, for which a
+    scoring forward pass of ``model`` does not run out of memory."""
+    text_features = model.encode_text()
+    height, width = cfg.INPUT.SIZE
+    batch_size = max_batch_size
+    while batch_size > 1:
+        try:
+            image = torch.zeros(batch_size, 3, height, width, device=device)
+            model(image, get_feature=True, text_features=text_features)
+            torch.cuda.synchronize(device)
+            break
+        except torch.cuda.OutOfMemoryError:
+            batch_size //= 2
+        finally:
+            image = None
+            torch.cuda.empty_cache()
+    return batch_size
+
+
+def tune_infer_batch_size(cfg, model, device):
+    """Set DATALOADER.INFER.BATCH_SIZE to the largest batch size that fits
+    ``model`` on ``device``.
+
+    Results are kept in DATALOADER.INFER.CACHE_FILE per backbone, precision,
+    input size and GPU, so the probe runs once per setup.
+    """
+    if device.type != "cuda":
+        print("Inference batch size tuning needs a GPU, keeping the configured size")
+        return infer_batch_size(cfg)
+
+    cache_file = cfg.DATALOADER.INFER.CACHE_FILE
+    key = "|".join([
+        cfg.MODEL.BACKBONE.NAME, cfg.TRAINER.COOP.PREC,
+        "x".join(map(str, cfg.INPUT.SIZE)), torch.cuda.get_device_name(device),
+    ])
+    cache = {}
+    if cache_file and osp.exists(cache_file):
+        with open(cache_file, "r") as f:
+            cache = json.load(f)
+
+    if key in cache:
+        batch_size = cache[key]
+        print(f"Inference batch size {batch_size} (cached in {cache_file})")
+    else:
+        batch_size = probe_batch_size(model, cfg, device, cfg.DATALOADER.INFER.MAX_BATCH_SIZE)
+        print(f"Inference batch size {batch_size} (tuned for {key})")
+        if cache_file:
+            # Merge with what other runs may have written in the meantime
+            if osp.exists(cache_file):
+                with open(cache_file, "r") as f:
+                    cache = json.load(f)
+            cache[key] = batch_size
+            mkdir_if_missing(osp.dirname(cache_file) or ".")
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            with open(tmp_file, "w") as f:
+                json.dump(cache, f, indent=4)
+            os.replace(tmp_file, cache_file)
+
+    cfg.defrost()
+    cfg.DATALOADER.INFER.BATCH_SIZE = batch_size
+    cfg.freeze()
+    return batch_size
+
+
+class SubsetSampler(Sampler):
+    """Sequential sampler over an index list that can be replaced between
+    passes. Samplers run in the main process, so workers that outlive a
+    pass pick up the new indices."""
+
+    def __init__(self, indices=()):
+        self.indices = list(indices)
+
+    def set_indices(self, indices):
+        self.indices = list(indices)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class InferenceLoader:
+    """Eval-transform loader over the whole pool that lives for the run.
+
+    Its workers are persistent, so every scoring pass of every selector (and
+    of the feature cache) in every round reuses them instead of starting a
+    new worker pool. A pass over any part of the pool only swaps the
+    indices of the sampler.
+
+    Args:
+        cfg (CfgNode): config.
+        data_source (list): list of Datum of the whole pool.
+        batch_size (int): inference batch size.
+    """
+
+    def __init__(self, cfg, data_source, batch_size):
+        self.data_source = data_source
+        self.batch_size = batch_size
+        self.index = {item.impath: i for i, item in enumerate(data_source)}
+        self.sampler = SubsetSampler()
+        self.loader = build_data_loader(
+            cfg,
+            data_source=data_source,
+            batch_size=batch_size,
+            tfm=build_transform(cfg, is_train=False),
+            is_train=False,
+            sampler=self.sampler,
+            persistent_workers=True,
+        )
+
+    def pool_indices(self, data_source):
+        """Pool indices of the items of ``data_source``, or None if some of
+        them are not in the pool."""
+        if data_source is self.data_source:
+            return range(len(self.data_source))
+        if isinstance(data_source, torch.utils.data.Subset):
+            base = self.pool_indices(data_source.dataset)
+            if base is None:
+                return None
+            return [base[i] for i in data_source.indices]
+        indices = [self.index.get(item.impath) for item in data_source]
+        if any(i is None for i in indices):
+            return None
+        return indices
+
+    def loader_for(self, data_source):
+        """The shared loader set up to iterate ``data_source`` in order, or
+        None if ``data_source`` is not part of the pool."""
+        indices = self.pool_indices(data_source)
+        if indices is None:
+            return None
+        self.sampler.set_indices(indices)
+        return self.loader
@@ -0,0 +1,40 @@
+import os
+import hashlib
+import os.path as osp
+
+import torch
+
+from clip import clip
+from dassl.utils import mkdir_if_missing
+
+
+def tokenize_prompts(prompts, name_texts, cache_dir=""):
+    """Tokenize ``prompts`` and count the BPE tokens of ``name_texts``.
+
+    Both lists are tokenized in a single batch. Descriptor files turn into
+    thousands of prompts, so if ``cache_dir`` is given the result is also
+    stored there under a hash of the texts, which already covers the
+    descriptor file, the context prefix and the class names. Later builds
+    (other rounds, seeds or runs) then only load it.
+
+    Returns:
+        tokenized prompts (torch.LongTensor) and the list of name lengths.
+    """
+    path = None
+    if cache_dir:
+        key = hashlib.sha1("\n".join(prompts + ["<|names|>"] + name_texts).encode("utf-8")).hexdigest()[:16]
+        path = osp.join(cache_dir, f"tokens_{key}.pth")
+        if osp.exists(path):
+            data = torch.load(path, map_location="cpu")
+            return data["tokenized_prompts"], data["name_lens"]
+
+    # A name text is a part of its prompt, so it fits whenever the prompt does
+    tokens, lengths = clip.tokenize_with_lengths(prompts + name_texts)
+    tokenized_prompts, name_lens = tokens[:len(prompts)], lengths[len(prompts):]
+
+    if path is not None:
+        mkdir_if_missing(cache_dir)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        torch.save({"tokenized_prompts": tokenized_prompts, "name_lens": name_lens}, tmp_path)
+        os.replace(tmp_path, path)
+    return tokenized_prompts, name_lens